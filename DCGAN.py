@@ -27,8 +27,23 @@ if __name__ == '__main__':
 	parser.add_argument('--cuda', type=bool, default=True, help='enables cuda')
 	parser.add_argument('--n_gpu', type=int, default=1, help='number of GPUs to use')
 	parser.add_argument('--n_workers', type=int, default=2, help='Number of subprocess to use to load the data. Use at least 2 or the number of cpu cores - 1.')
+	parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'], help='Precision of the forward and backward passes of D and G (autocast), fp16 also scales the gradients.')
+	parser.add_argument('--compile', type=bool, default=False, help='Compile D and G with torch.compile (falls back to eager mode if not supported), the first iterations are slower.')
+	parser.add_argument('--memory_format', default='contiguous', choices=['contiguous', 'channels_last'], help='Memory format of the models and of the batches, channels_last (NHWC) convolutions are often faster. The layers getting tensors in another format are reported after the first step.')
+	parser.add_argument('--static_shapes', type=bool, default=False, help='Drop the last incomplete batch of every epoch so that all the steps have the same shapes (for cudnn.benchmark and compiled graphs).')
+	parser.add_argument('--n_buffers', type=int, default=2, help='Number of batches staged in advance (in pinned memory and on the GPU if cuda) by the background prefetcher.')
+	parser.add_argument('--loader', default='pil', choices=['pil', 'jpeg'], help='pil: ImageFolder decoding the images one by one with PIL, jpeg: batched decoding of the raw JPEG files with torchvision.io.decode_jpeg.')
+	parser.add_argument('--data_cache', default='', help='Memory-mapped image cache made by data_cache.py with the same image_size, used instead of input_folder (ex: ./cache_64.npy)')
 	parser.add_argument('--weight_decay', type=float, default=0, help='L2 regularization weight. Greatly helps convergence but leads to artifacts in images, not recommended.')
 	parser.add_argument('--gen_extra_images', type=int, default=0, help='Every epoch, generate additional images with "batch_size" random fake cats.')
+	parser.add_argument('--metrics', nargs='+', default=['tensorboard'], choices=['tensorboard', 'csv', 'jsonl'], help='Where the losses are logged, in the logs folder (ex: --metrics tensorboard csv)')
+	parser.add_argument('--log_every', type=int, default=50, help='The logged losses are the mean, min and max over this number of steps')
+	parser.add_argument('--fakes_memory', type=int, default=1024, help='Memory cap in MB of one forward pass of G for the extra images')
+	parser.add_argument('--resume', default='', help='Folder of a stopped run to continue exactly where it stopped, from its last checkpoint (ex: /home/output_folder/run-5). Use the same options.')
+	parser.add_argument('--deterministic', type=bool, default=False, help='Only deterministic algorithms (and no cudnn.benchmark), a resumed run is then identical to an uninterrupted one.')
+	parser.add_argument('--keep_last', type=int, default=0, help='Keep only the last K checkpoints of the models, 0 keeps all of them. The best one is also kept when there is a metric (|W_distance| in the WGANs).')
+	parser.add_argument('--keep_every', type=int, default=0, help='With --keep_last, also keep every M-th checkpoint as an archive.')
+	parser.add_argument('--archive_precision', default='fp32', choices=['fp32', 'fp16', 'bf16'], help='Precision of the archived checkpoints (older than the last K), fp16 or bf16 halves their size.')
 	param = parser.parse_args()
 
 	## Imports
@@ -39,21 +54,36 @@ if __name__ == '__main__':
 
 	# Check folder run-i for all i=0,1,... until it finds run-j which does not exists, then creates a new folder run-j
 	import os
-	run = 0
-	base_dir = f"{param.output_folder}/run-{run}"
-	while os.path.exists(base_dir):
-		run += 1
+	if param.resume != '':
+		# Continue in the folder of the stopped run
+		base_dir = param.resume.rstrip('/')
+		param.output_folder = os.path.dirname(base_dir) or '.'
+		name = os.path.basename(base_dir)
+		if not (name.startswith('run-') and name[len('run-'):].isdigit()):
+			parser.error(f"--resume {param.resume} is not a run folder (run-N, made by a previous training)")
+		# Checked before creating any folder or opening the log of the run
+		from checkpoint import TRAINING_STATE, training_state_path
+		if not os.path.exists(training_state_path(base_dir)):
+			parser.error(f"--resume {param.resume} has no checkpoint to resume from ({TRAINING_STATE} is missing)")
+		run = int(name[len('run-'):])
+		logs_dir = f"{base_dir}/logs"
+		os.makedirs(f"{base_dir}/images/extra", exist_ok=True)
+	else:
+		run = 0
 		base_dir = f"{param.output_folder}/run-{run}"
-	os.mkdir(base_dir)
-	logs_dir = f"{base_dir}/logs"
-	os.mkdir(logs_dir)
-	os.mkdir(f"{base_dir}/images")
-	os.mkdir(f"{base_dir}/models")
-	if param.gen_extra_images > 0:
-		os.mkdir(f"{base_dir}/images/extra")
-
-	# where we save the output
-	log_output = open(f"{logs_dir}/log.txt", 'w')
+		while os.path.exists(base_dir):
+			run += 1
+			base_dir = f"{param.output_folder}/run-{run}"
+		os.mkdir(base_dir)
+		logs_dir = f"{base_dir}/logs"
+		os.mkdir(logs_dir)
+		os.mkdir(f"{base_dir}/images")
+		os.mkdir(f"{base_dir}/models")
+		if param.gen_extra_images > 0:
+			os.mkdir(f"{base_dir}/images/extra")
+
+	# where we save the output (after the log of the stopped run if resuming)
+	log_output = open(f"{logs_dir}/log.txt", 'a' if param.resume != '' else 'w')
 	print(param)
 	print(param, file=log_output)
 
@@ -61,9 +91,9 @@ if __name__ == '__main__':
 	import torch.autograd as autograd
 	from torch.autograd import Variable
 
-	# For plotting the Loss of D and G using tensorboard
-	from tensorboard_logger import configure, log_value
-	configure(logs_dir, flush_secs=5)
+	# For plotting the Loss of D and G using tensorboard (and/or csv, jsonl files), mean, min and max over windows of log_every steps
+	from metrics import Metrics, make_sinks
+	metrics = Metrics(make_sinks(param.metrics, logs_dir), param.log_every)
 
 	import torchvision
 	import torchvision.datasets as dset
@@ -73,7 +103,9 @@ if __name__ == '__main__':
 
 	if param.cuda:
 		import torch.backends.cudnn as cudnn
-		cudnn.benchmark = True
+		cudnn.benchmark = not param.deterministic
+	if param.deterministic:
+		torch.use_deterministic_algorithms(True, warn_only=True)
 
 	# To see images
 	from IPython.display import Image
@@ -81,6 +113,13 @@ if __name__ == '__main__':
 
 	import math
 
+	# Training state of the stopped run (its seed is used again)
+	resume_state = None
+	if param.resume != '':
+		from checkpoint import load_training_state
+		resume_state = load_training_state(base_dir)
+		param.seed = resume_state['seed']
+
 	## Setting seed
 	import random
 	param.seed = param.seed or random.randint(1, 10000)
@@ -101,10 +140,40 @@ if __name__ == '__main__':
 	])
 
 	## Importing dataset
-	data = dset.ImageFolder(root=param.input_folder, transform=trans)
-
-	# Loading data in batch
-	dataset = torch.utils.data.DataLoader(data, batch_size=param.batch_size, shuffle=True, num_workers=param.n_workers)
+	if param.data_cache != '':
+		# Images already decoded and resized, batches are slices of the cache
+		from data_cache import CachedImages, CachedLoader
+		data = CachedImages(param.data_cache, param.image_size)
+		dataset = CachedLoader(data, batch_size=param.batch_size, shuffle=True, drop_last=param.static_shapes)
+		# The shuffles of the epochs already done
+		if resume_state is not None:
+			dataset.skip(resume_state['epoch']*len(dataset))
+	else:
+		if param.loader == 'jpeg':
+			# Raw bytes, the batches are decoded at once in the workers
+			from jpeg_loader import JpegFiles, JpegDecoder
+			data = JpegFiles(param.input_folder)
+			collate_fn = JpegDecoder(param.image_size)
+		else:
+			data = dset.ImageFolder(root=param.input_folder, transform=trans)
+			collate_fn = None
+
+		# Loading data in batch, shuffled by its own generator (saved in the checkpoints, the batches are loaded in the background)
+		# The workers are started once (not at every epoch) from a forkserver, see data_stream.worker_context
+		from data_stream import worker_context
+		data_generator = torch.Generator()
+		data_generator.manual_seed(param.seed)
+		# The seeds of the workers come from another generator, so that data_generator only draws the permutation of each epoch
+		worker_generator = torch.Generator()
+		worker_generator.manual_seed(param.seed)
+		sampler = torch.utils.data.RandomSampler(data, generator=data_generator)
+		dataset = torch.utils.data.DataLoader(data, batch_size=param.batch_size, sampler=sampler, num_workers=param.n_workers, pin_memory=param.cuda, collate_fn=collate_fn, drop_last=param.static_shapes, generator=worker_generator, persistent_workers=param.n_workers > 0, multiprocessing_context=worker_context(param.n_workers))
+		if resume_state is not None:
+			data_generator.set_state(resume_state['data_generator'])
+	# Next batch copied in the background while the current one is used
+	from data_stream import Prefetcher
+	from train_utils import MEMORY_FORMATS
+	dataset = Prefetcher(dataset, param.batch_size, cuda=param.cuda, n_buffers=param.n_buffers, memory_format=MEMORY_FORMATS[param.memory_format])
 
 	## Models
 	# The number of layers is implicitly determined by the image size
@@ -237,8 +306,9 @@ if __name__ == '__main__':
 	criterion = torch.nn.BCELoss()
 
 	# Soon to be variables
-	x = torch.FloatTensor(param.batch_size, param.n_colors, param.image_size, param.image_size)
-	y = torch.FloatTensor(param.batch_size)
+	# Constant labels, the labels of a smaller batch are a view of them
+	y_real = torch.ones(param.batch_size)
+	y_fake = torch.zeros(param.batch_size)
 	z = torch.FloatTensor(param.batch_size, param.z_size, 1, 1)
 	# This is to see during training, size and values won't change
 	z_test = torch.FloatTensor(param.batch_size, param.z_size, 1, 1).normal_(0, 1)
@@ -248,35 +318,89 @@ if __name__ == '__main__':
 		G = G.cuda()
 		D = D.cuda()
 		criterion = criterion.cuda()
-		x = x.cuda()
-		y = y.cuda()
+		y_real = y_real.cuda()
+		y_fake = y_fake.cuda()
 		z = z.cuda()
 		z_test = z_test.cuda()
 
 	# Now Variables
-	x = Variable(x)
-	y = Variable(y)
+	y_real = Variable(y_real)
+	y_fake = Variable(y_fake)
 	z = Variable(z)
 	z_test = Variable(z_test)
 
+	# Memory format of the weights (the prefetcher stages the real images in this format and the fake images follow from G)
+	G = G.to(memory_format=MEMORY_FORMATS[param.memory_format])
+	D = D.to(memory_format=MEMORY_FORMATS[param.memory_format])
+
 	# Based on DCGAN paper, they found using betas[0]=.50 better.
 	# betas[0] represent is the weight given to the previous mean of the gradient
 	# betas[1] is the weight given to the previous variance of the gradient
 	optimizerD = torch.optim.Adam(D.parameters(), lr=param.lr_D, betas=(param.beta1, 0.999), weight_decay=param.weight_decay)
 	optimizerG = torch.optim.Adam(G.parameters(), lr=param.lr_G, betas=(param.beta1, 0.999), weight_decay=param.weight_decay)
 
+	# Mixed precision (autocast) and gradient scaling (only with fp16)
+	from train_utils import Precision
+	amp = Precision(param.precision, param.cuda)
+	scalerD = amp.scaler()
+	scalerG = amp.scaler()
+
+	# Compiled D and G (warmed up on a batch of zeros to measure the compilation time)
+	if param.compile:
+		from train_utils import compile_model
+		z_example = torch.zeros(param.batch_size, param.z_size, 1, 1)
+		x_example = torch.zeros(param.batch_size, param.n_colors, param.image_size, param.image_size).contiguous(memory_format=MEMORY_FORMATS[param.memory_format])
+		if param.cuda:
+			z_example = z_example.cuda()
+			x_example = x_example.cuda()
+		for model, example, name in [(G, z_example, 'G'), (D, x_example, 'D')]:
+			s = compile_model(model, example, amp, name)
+			print(s)
+			print(s, file=log_output)
+
+	# Layers getting tensors in another memory format during the first step (only in eager mode)
+	layout_check = None
+	if param.memory_format != 'contiguous' and not param.compile:
+		from train_utils import LayoutCheck
+		layout_check = LayoutCheck({'G': G, 'D': D}, MEMORY_FORMATS[param.memory_format])
+
+	# Sample images encoded and written by background threads
+	from train_utils import FakeBatches, ImageWriter
+	image_writer = ImageWriter()
+	extra_images = FakeBatches(G, param.z_size, amp, param.fakes_memory)
+
+	# Models saved by a background thread
+	from checkpoint import CheckpointStore, CheckpointWriter, rng_state, training_state_path
+	# Old checkpoints deleted or archived according to --keep_last and --keep_every, listed in models/index.json
+	checkpoints = CheckpointWriter(CheckpointStore(f"{base_dir}/models", param.keep_last, param.keep_every, param.archive_precision))
+
+	# Continuing the stopped run after its last checkpoint
+	start_epoch = 0
+	if resume_state is not None:
+		from checkpoint import set_rng_state
+		G.load_state_dict(resume_state['G'])
+		D.load_state_dict(resume_state['D'])
+		optimizerG.load_state_dict(resume_state['optimizerG'])
+		optimizerD.load_state_dict(resume_state['optimizerD'])
+		scalerG.load_state_dict(resume_state['scalerG'])
+		scalerD.load_state_dict(resume_state['scalerD'])
+		z_test.data.copy_(resume_state['z_test'])
+		start_epoch = resume_state['epoch']
+		set_rng_state(resume_state['rng'])
+		print(f"Resuming {base_dir} at epoch {start_epoch}")
+		print(f"Resuming {base_dir} at epoch {start_epoch}", file=log_output)
+
 	## Fitting model
-	for epoch in range(param.n_epoch):
+	for epoch in range(start_epoch, param.n_epoch):
 
 		# Fake images saved
-		fake_test = G(z_test)
-		vutils.save_image(fake_test.data, '%s/run-%d/images/fake_samples_epoch%03d.png' % (param.output_folder, run, epoch), normalize=True)
-		for ext in range(param.gen_extra_images):
-			z_extra = torch.FloatTensor(param.batch_size, param.z_size, 1, 1).normal_(0, 1)
-			if param.cuda:
-				z_extra = z_extra.cuda()
-			fake_test = G(Variable(z_extra))
-			vutils.save_image(fake_test.data, '%s/run-%d/images/extra/fake_samples_epoch%03d_extra%01d.png' % (param.output_folder, run, epoch, ext), normalize=True)
+		with torch.no_grad(), amp.autocast():
+			fake_test = G(z_test)
+		image_writer.save(fake_test, '%s/run-%d/images/fake_samples_epoch%03d.png' % (param.output_folder, run, epoch))
+		# Extra images in a few no-grad forward passes of G
+		if param.gen_extra_images > 0:
+			for ext, fake_extra in enumerate(extra_images.generate(param.gen_extra_images, param.batch_size)):
+				image_writer.save(fake_extra, '%s/run-%d/images/extra/fake_samples_epoch%03d_extra%01d.png' % (param.output_folder, run, epoch, ext))
 
 		for i, data_batch in enumerate(dataset, 0):
 			########################
@@ -292,29 +416,32 @@ if __name__ == '__main__':
 			images, labels = data_batch
 			# Mostly necessary for the last one because if N might not be a multiple of batch_size
 			current_batch_size = images.size(0)
-			if param.cuda:
-				images = images.cuda()
-			# Transfer batch of images to x
-			x.data.resize_as_(images).copy_(images)
+			# The prefetcher already transferred the batch of images (to the GPU if cuda) to its buffer
+			x = Variable(images)
 			# y is now a vector of size current_batch_size filled with 1
-			y.data.resize_(current_batch_size).fill_(1)
-			y_pred = D(x)
-			errD_real = criterion(y_pred, y)
-			errD_real.backward()
+			y = y_real[:current_batch_size]
+			with amp.autocast():
+				y_pred = D(x)
+			# BCE is computed in float32 (not safe in reduced precision)
+			errD_real = criterion(y_pred.float(), y)
+			scalerD.scale(errD_real).backward()
 			# Var has data and gradient element, we keep the mean of the data element
 			D_real = y_pred.data.mean()
 
 			# Train with fake data
-			z.data.resize_(current_batch_size, param.z_size, 1, 1).normal_(0, 1)
-			x_fake = G(z)
-			y.data.resize_(current_batch_size).fill_(0)
-			# Detach y_pred from the neural network G and put it inside D
-			y_pred_fake = D(x_fake.detach())
-			errD_fake = criterion(y_pred_fake, y)
-			errD_fake.backward()
+			# A view of the preallocated z (no reallocation for a smaller batch)
+			z_batch = z[:current_batch_size].normal_(0, 1)
+			with amp.autocast():
+				x_fake = G(z_batch)
+				# Detach y_pred from the neural network G and put it inside D
+				y_pred_fake = D(x_fake.detach())
+			y = y_fake[:current_batch_size]
+			errD_fake = criterion(y_pred_fake.float(), y)
+			scalerD.scale(errD_fake).backward()
 			D_fake = y_pred_fake.data.mean()
 			errD = errD_real + errD_fake
-			optimizerD.step()
+			scalerD.step(optimizerD)
+			scalerD.update()
 
 			########################
 			# (2) Update G network #
@@ -326,26 +453,49 @@ if __name__ == '__main__':
 
 			G.zero_grad()
 			# Generator wants to fool discriminator so it wants to minimize loss of discriminator assuming label is True
-			y.data.resize_(current_batch_size).fill_(1)
-			y_pred_fake = D(x_fake)
-			errG = criterion(y_pred_fake, y)
-			errG.backward(retain_graph=True)
+			y = y_real[:current_batch_size]
+			with amp.autocast():
+				y_pred_fake = D(x_fake)
+			errG = criterion(y_pred_fake.float(), y)
+			# The graphs of G and D are freed by this backward, nothing uses them afterwards
+			scalerG.scale(errG).backward()
 			D_G = y_pred_fake.data.mean()
-			optimizerG.step()
+			scalerG.step(optimizerG)
+			scalerG.update()
+
+			if layout_check is not None:
+				s = layout_check.report()
+				print(s)
+				print(s, file=log_output)
+				layout_check = None
 
 			current_step = i + epoch*len(dataset)
-			# Log results so we can see them in TensorBoard after
-			log_value('errD', errD.item(), current_step)
-			log_value('errG', errG.item(), current_step)
+			# Log results so we can see them in TensorBoard after (kept on the device, written every log_every steps by metrics.py)
+			metrics.log(current_step, errD=errD, errG=errG)
 
 			if i % 50 == 0:
 				end = time.time()
-				fmt = '[%d/%d][%d/%d] Loss_D: %.4f Loss_G: %.4f D(x): %.4f D(G(z)): %.4f / %.4f time:%.4f'
-				s = fmt % (epoch, param.n_epoch, i, len(dataset), errD.item(),  errG.item(), D_real, D_fake, D_G, end - start)
+				fmt = '[%d/%d][%d/%d] Loss_D: %.4f Loss_G: %.4f D(x): %.4f D(G(z)): %.4f / %.4f time:%.4f data_wait:%.4f'
+				s = fmt % (epoch, param.n_epoch, i, len(dataset), errD.item(),  errG.item(), D_real, D_fake, D_G, end - start, dataset.pop_wait())
 				print(s)
 				print(s, file=log_output)
+				for s in checkpoints.pop_reports():
+					print(s)
+					print(s, file=log_output)
 		# Save every epoch
 		fmt = '%s/run-%d/models/%s_epoch_%d.pth'
 		if epoch % 25 == 0:
-			torch.save(G.state_dict(), fmt % (param.output_folder, run, 'G', epoch))
-			torch.save(D.state_dict(), fmt % (param.output_folder, run, 'D', epoch))
+			# Copied to host memory here, written in the background
+			# Everything needed to continue after this epoch (--resume), written last
+			state = {'G': G.state_dict(), 'D': D.state_dict(), 'optimizerG': optimizerG.state_dict(), 'optimizerD': optimizerD.state_dict(),
+				'scalerG': scalerG.state_dict(), 'scalerD': scalerD.state_dict(), 'z_test': z_test.data, 'seed': param.seed, 'epoch': epoch + 1,
+				'rng': rng_state(param.cuda), 'data_generator': data_generator.get_state() if param.data_cache == '' else None}
+			checkpoints.save([(G.state_dict(), fmt % (param.output_folder, run, 'G', epoch)), (D.state_dict(), fmt % (param.output_folder, run, 'D', epoch)), (state, training_state_path(base_dir))], step=epoch)
+
+	# Waiting for the last checkpoint and images
+	checkpoints.close()
+	image_writer.close()
+	metrics.close()
+	for s in checkpoints.pop_reports():
+		print(s)
+		print(s, file=log_output)
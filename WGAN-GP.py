@@ -32,7 +32,28 @@ if __name__ == '__main__':
 	parser.add_argument('--D_load', default='', help='Full path to Discriminator model to load (ex: /home/output_folder/run-5/models/D_epoch_11.pth)')
 	parser.add_argument('--cuda', type=bool, default=True, help='enables cuda')
 	parser.add_argument('--n_gpu', type=int, default=1, help='number of GPUs to use')
+	parser.add_argument('--n_workers', type=int, default=2, help='Number of subprocess to use to load the data. Use at least two or the number of cpu cores - 1.')
+	parser.add_argument('--prefetch', type=int, default=2, help='Number of batches loaded in advance by each worker.')
+	parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'], help='Precision of the forward and backward passes of D and G (autocast), fp16 also scales the gradients.')
+	parser.add_argument('--compile', type=bool, default=False, help='Compile D and G with torch.compile (falls back to eager mode if not supported), the first iterations are slower.')
+	parser.add_argument('--memory_format', default='contiguous', choices=['contiguous', 'channels_last'], help='Memory format of the models and of the batches, channels_last (NHWC) convolutions are often faster. The layers getting tensors in another format are reported after the first step.')
+	parser.add_argument('--lipschitz', default='gp', choices=['gp', 'spectral'], help='Lipschitz constraint of D, gp: gradient penalty, spectral: spectral normalization of the convolutions of D (cheaper).')
+	parser.add_argument('--power_iterations', type=int, default=1, help='Number of power iterations per forward pass of D to estimate the spectral norms (with --lipschitz spectral)')
+	parser.add_argument('--fused_critic', type=bool, default=False, help='Real and fake images in a single forward pass of D, and a single backward with the penalty, at every critic step.')
+	parser.add_argument('--penalty_every', type=int, default=1, help='Lazy regularization: compute the gradient penalty only every k critic steps, multiplied by k. Much faster, slightly less regularized.')
+	parser.add_argument('--batch_fakes', type=bool, default=False, help='Generate the fake images of all the critic steps in one forward pass of G (or a few if they use more than fakes_memory).')
+	parser.add_argument('--fakes_memory', type=int, default=1024, help='Memory cap in MB of one forward pass of G with --batch_fakes and for the extra images')
+	parser.add_argument('--n_buffers', type=int, default=2, help='Number of batches staged in advance (in pinned memory and on the GPU if cuda) by the background prefetcher.')
+	parser.add_argument('--loader', default='pil', choices=['pil', 'jpeg'], help='pil: ImageFolder decoding the images one by one with PIL, jpeg: batched decoding of the raw JPEG files with torchvision.io.decode_jpeg.')
+	parser.add_argument('--data_cache', default='', help='Memory-mapped image cache made by data_cache.py with the same image_size, used instead of input_folder (ex: ./cache_64.npy)')
 	parser.add_argument('--gen_extra_images', type=int, default=0, help='Every 50 generator iterations, generate additional images with "batch_size" random fake cats.')
+	parser.add_argument('--metrics', nargs='+', default=['tensorboard'], choices=['tensorboard', 'csv', 'jsonl'], help='Where the losses are logged, in the logs folder (ex: --metrics tensorboard csv)')
+	parser.add_argument('--log_every', type=int, default=50, help='The logged losses are the mean, min and max over this number of steps')
+	parser.add_argument('--resume', default='', help='Folder of a stopped run to continue exactly where it stopped, from its last checkpoint (ex: /home/output_folder/run-5). Use the same options.')
+	parser.add_argument('--deterministic', type=bool, default=False, help='Only deterministic algorithms (and no cudnn.benchmark), a resumed run is then identical to an uninterrupted one.')
+	parser.add_argument('--keep_last', type=int, default=0, help='Keep only the last K checkpoints of the models, 0 keeps all of them. The best one is also kept when there is a metric (|W_distance| in the WGANs).')
+	parser.add_argument('--keep_every', type=int, default=0, help='With --keep_last, also keep every M-th checkpoint as an archive.')
+	parser.add_argument('--archive_precision', default='fp32', choices=['fp32', 'fp16', 'bf16'], help='Precision of the archived checkpoints (older than the last K), fp16 or bf16 halves their size.')
 	param = parser.parse_args()
 
 	## Imports
@@ -43,33 +64,48 @@ if __name__ == '__main__':
 
 	# Check folder run-i for all i=0,1,... until it finds run-j which does not exists, then creates a new folder run-j
 	import os
-	run = 0
-
-	base_dir = f"{param.output_folder}/run-{run}"
-	while os.path.exists(base_dir):
-		run += 1
+	if param.resume != '':
+		# Continue in the folder of the stopped run
+		base_dir = param.resume.rstrip('/')
+		param.output_folder = os.path.dirname(base_dir) or '.'
+		name = os.path.basename(base_dir)
+		if not (name.startswith('run-') and name[len('run-'):].isdigit()):
+			parser.error(f"--resume {param.resume} is not a run folder (run-N, made by a previous training)")
+		# Checked before creating any folder or opening the log of the run
+		from checkpoint import TRAINING_STATE, training_state_path
+		if not os.path.exists(training_state_path(base_dir)):
+			parser.error(f"--resume {param.resume} has no checkpoint to resume from ({TRAINING_STATE} is missing)")
+		run = int(name[len('run-'):])
+		logs_dir = f"{base_dir}/logs"
+		os.makedirs(f"{base_dir}/images/extra", exist_ok=True)
+	else:
+		run = 0
 		base_dir = f"{param.output_folder}/run-{run}"
-	os.mkdir(base_dir)
-	logs_dir = f"{base_dir}/logs"
-	os.mkdir(logs_dir)
-	os.mkdir(f"{base_dir}/images")
-	os.mkdir(f"{base_dir}/models")
-	if param.gen_extra_images > 0:
-		os.mkdir(f"{base_dir}/images/extra")
-
-	# where we save the output
-	log_output = open(f"{logs_dir}/log.txt", 'w')
+		while os.path.exists(base_dir):
+			run += 1
+			base_dir = f"{param.output_folder}/run-{run}"
+		os.mkdir(base_dir)
+		logs_dir = f"{base_dir}/logs"
+		os.mkdir(logs_dir)
+		os.mkdir(f"{base_dir}/images")
+		os.mkdir(f"{base_dir}/models")
+		if param.gen_extra_images > 0:
+			os.mkdir(f"{base_dir}/images/extra")
+
+	# where we save the output (after the log of the stopped run if resuming)
+	log_output = open(f"{logs_dir}/log.txt", 'a' if param.resume != '' else 'w')
 	print(param)
 	print(param, file=log_output)
 
+	import contextlib
 	import numpy
 	import torch
 	import torch.autograd as autograd
 	from torch.autograd import Variable
 
-	# For plotting the Loss of D and G using tensorboard
-	from tensorboard_logger import configure, log_value
-	configure(logs_dir, flush_secs=5)
+	# For plotting the Loss of D and G using tensorboard (and/or csv, jsonl files), mean, min and max over windows of log_every steps
+	from metrics import Metrics, make_sinks
+	metrics = Metrics(make_sinks(param.metrics, logs_dir), param.log_every)
 
 	import torchvision
 	import torchvision.datasets as dset
@@ -79,12 +115,21 @@ if __name__ == '__main__':
 
 	if param.cuda:
 		import torch.backends.cudnn as cudnn
-		cudnn.benchmark = True
+		cudnn.benchmark = not param.deterministic
+	if param.deterministic:
+		torch.use_deterministic_algorithms(True, warn_only=True)
 
 	# To see images
 	from IPython.display import Image
 	to_img = transf.ToPILImage()
 
+	# Training state of the stopped run (its seed is used again)
+	resume_state = None
+	if param.resume != '':
+		from checkpoint import load_training_state
+		resume_state = load_training_state(base_dir)
+		param.seed = resume_state['seed']
+
 	## Setting seed
 	import random
 	if param.seed is None:
@@ -106,15 +151,27 @@ if __name__ == '__main__':
 	])
 
 	## Importing dataset
-	data = dset.ImageFolder(root=param.input_folder, transform=trans)
-
-	# Generate a random sample
-	def generate_random_sample():
-		while True:
-			random_indexes = numpy.random.choice(data.__len__(), size=param.batch_size, replace=False)
-			batch = [data[i][0] for i in random_indexes]
-			yield torch.stack(batch, 0)
-	random_sample = generate_random_sample()
+	collate_fn = None
+	if param.data_cache != '':
+		# Images already decoded and resized
+		from data_cache import CachedImages
+		data = CachedImages(param.data_cache, param.image_size)
+	elif param.loader == 'jpeg':
+		# Raw bytes, the batches are decoded at once in the workers
+		from jpeg_loader import JpegFiles, JpegDecoder
+		data = JpegFiles(param.input_folder)
+		collate_fn = JpegDecoder(param.image_size)
+	else:
+		data = dset.ImageFolder(root=param.input_folder, transform=trans)
+
+	# Generate a random sample (decoded in parallel by the workers and prefetched while D trains)
+	from data_stream import Prefetcher, random_batches
+	from train_utils import MEMORY_FORMATS
+	# The next sample is also copied in the background (to the GPU if cuda) while the current one is used
+	# When resuming, the samples of the iterations already done are skipped (n_critic per iteration)
+	start_sample = resume_state['i']*param.n_critic if resume_state is not None else 0
+	prefetcher = Prefetcher(random_batches(data, param.batch_size, param.seed, n_workers=param.n_workers, prefetch=param.prefetch, pin_memory=param.cuda, collate_fn=collate_fn, start=start_sample), param.batch_size, cuda=param.cuda, n_buffers=param.n_buffers, memory_format=MEMORY_FORMATS[param.memory_format])
+	random_sample = iter(prefetcher)
 
 	## Models
 	# The number of layers is implicitly determined by the image size
@@ -233,6 +290,11 @@ if __name__ == '__main__':
 	G.apply(weights_init)
 	D.apply(weights_init)
 
+	# Spectral normalization of the convolutions of D (instead of clipping or the gradient penalty)
+	if param.lipschitz == 'spectral':
+		from train_utils import spectral_norm
+		spectral_norm(D, param.power_iterations)
+
 	# Load existing models
 	if param.G_load != '':
 		G.load_state_dict(torch.load(param.G_load))
@@ -245,7 +307,6 @@ if __name__ == '__main__':
 	print(D, file=log_output)
 
 	# Soon to be variables
-	x = torch.FloatTensor(param.batch_size, param.n_colors, param.image_size, param.image_size)
 	# Weighted sum of fake and real image, for gradient penalty
 	x_both = torch.FloatTensor(param.batch_size, param.n_colors, param.image_size, param.image_size)
 	z = torch.FloatTensor(param.batch_size, param.z_size, 1, 1)
@@ -262,7 +323,6 @@ if __name__ == '__main__':
 	if param.cuda:
 		G = G.cuda()
 		D = D.cuda()
-		x = x.cuda()
 		z = z.cuda()
 		u = u.cuda()
 		z_test = z_test.cuda()
@@ -270,31 +330,103 @@ if __name__ == '__main__':
 		one, one_neg = one.cuda(), one_neg.cuda()
 
 	# Now Variables
-	x = Variable(x)
 	z = Variable(z)
 	z_test = Variable(z_test)
 
+	# Memory format of the weights (the prefetcher stages the real images in this format and the fake images follow from G)
+	G = G.to(memory_format=MEMORY_FORMATS[param.memory_format])
+	D = D.to(memory_format=MEMORY_FORMATS[param.memory_format])
+
 	# Optimizer
 	optimizerD = torch.optim.Adam(D.parameters(), lr=param.lr_D, betas=(param.beta1, param.beta2))
 	optimizerG = torch.optim.Adam(G.parameters(), lr=param.lr_G, betas=(param.beta1, param.beta2))
 
+	# Mixed precision (autocast) and gradient scaling (only with fp16)
+	from train_utils import Precision, penalty_gradients, gradient_norm, fused_critic, SectionTimer
+	amp = Precision(param.precision, param.cuda)
+	scalerD = amp.scaler()
+	scalerG = amp.scaler()
+
+	# Compiled D and G (warmed up on a batch of zeros to measure the compilation time)
+	if param.compile:
+		from train_utils import compile_model
+		z_example = torch.zeros(param.batch_size, param.z_size, 1, 1)
+		x_example = torch.zeros(param.batch_size, param.n_colors, param.image_size, param.image_size).contiguous(memory_format=MEMORY_FORMATS[param.memory_format])
+		if param.cuda:
+			z_example = z_example.cuda()
+			x_example = x_example.cuda()
+		for model, example, name in [(G, z_example, 'G'), (D, x_example, 'D')]:
+			s = compile_model(model, example, amp, name)
+			print(s)
+			print(s, file=log_output)
+
+	# Layers getting tensors in another memory format during the first step (only in eager mode)
+	layout_check = None
+	if param.memory_format != 'contiguous' and not param.compile:
+		from train_utils import LayoutCheck
+		layout_check = LayoutCheck({'G': G, 'D': D}, MEMORY_FORMATS[param.memory_format])
+
+	# Time spent on the gradient penalty (with --fused_critic: the whole critic steps with the penalty)
+	penalty_timer = SectionTimer(param.cuda)
+	last_print = -1
+	# Penalty of the last critic step which had one, divided by penalty_every (its average contribution per critic step) for the logs
+	penalty_logged = 0
+
+	# Fake images of the critic steps generated together
+	from train_utils import FakeBatches, ImageWriter
+	if param.batch_fakes:
+		fake_batches = FakeBatches(G, param.z_size, amp, param.fakes_memory)
+		s = f"[fakes] {min(param.n_critic, fake_batches.chunk_size(param.batch_size))} critic steps of fake images per forward pass of G"
+		print(s)
+		print(s, file=log_output)
+
+	# Sample images encoded and written by background threads
+	image_writer = ImageWriter()
+	extra_images = FakeBatches(G, param.z_size, amp, param.fakes_memory)
+
+	# Models saved by a background thread
+	from checkpoint import CheckpointStore, CheckpointWriter, rng_state, training_state_path
+	# Old checkpoints deleted or archived according to --keep_last and --keep_every, listed in models/index.json
+	checkpoints = CheckpointWriter(CheckpointStore(f"{base_dir}/models", param.keep_last, param.keep_every, param.archive_precision))
+
+	# Continuing the stopped run after its last checkpoint
+	start_iter = 0
+	if resume_state is not None:
+		from checkpoint import set_rng_state
+		G.load_state_dict(resume_state['G'])
+		D.load_state_dict(resume_state['D'])
+		optimizerG.load_state_dict(resume_state['optimizerG'])
+		optimizerD.load_state_dict(resume_state['optimizerD'])
+		scalerG.load_state_dict(resume_state['scalerG'])
+		scalerD.load_state_dict(resume_state['scalerD'])
+		z_test.data.copy_(resume_state['z_test'])
+		start_iter = resume_state['i']
+		last_print = start_iter - 1
+		penalty_logged = resume_state['penalty_logged']
+		set_rng_state(resume_state['rng'])
+		print(f"Resuming {base_dir} at iteration {start_iter}")
+		print(f"Resuming {base_dir} at iteration {start_iter}", file=log_output)
+
 	## Fitting model
-	for i in range(param.n_iter):
+	for i in range(start_iter, param.n_iter):
 
 		# Fake images saved
 		if i % 50 == 0:
-			fake_test = G(z_test)
-			vutils.save_image(fake_test.data, '%s/run-%d/images/fake_samples_iter%03d.png' % (param.output_folder, run, i/50), normalize=True)
-			for ext in range(param.gen_extra_images):
-				z_extra = torch.FloatTensor(param.batch_size, param.z_size, 1, 1).normal_(0, 1)
-				if param.cuda:
-					z_extra = z_extra.cuda()
-				fake_test = G(Variable(z_extra))
-				vutils.save_image(fake_test.data, '%s/run-%d/images/extra/fake_samples_iter%03d_extra%01d.png' % (param.output_folder, run, i/50, ext), normalize=True)
+			with torch.no_grad(), amp.autocast():
+				fake_test = G(z_test)
+			image_writer.save(fake_test, '%s/run-%d/images/fake_samples_iter%03d.png' % (param.output_folder, run, i/50))
+			# Extra images in a few no-grad forward passes of G
+			if param.gen_extra_images > 0:
+				for ext, fake_extra in enumerate(extra_images.generate(param.gen_extra_images, param.batch_size)):
+					image_writer.save(fake_extra, '%s/run-%d/images/extra/fake_samples_iter%03d_extra%01d.png' % (param.output_folder, run, i/50, ext))
 
 		for p in D.parameters():
 			p.requires_grad = True
 
+		# Fake images of all the critic steps in a few forward passes of G
+		if param.batch_fakes:
+			fakes = fake_batches.generate(param.n_critic, param.batch_size)
+
 		for t in range(param.n_critic):
 
 			########################
@@ -305,40 +437,64 @@ if __name__ == '__main__':
 
 			# Sample real data
 			real_images = random_sample.__next__()
-			if param.cuda:
-				real_images = real_images.cuda()
-			x.data.copy_(real_images)
-			# Discriminator Loss real
-			errD_real = D(x)
-			errD_real = errD_real.mean()
-			errD_real.backward(one_neg)
+			x = Variable(real_images)
+
+			# Lazy regularization: the penalty (multiplied by penalty_every) only every penalty_every critic steps, never with spectral normalization
+			with_penalty = param.lipschitz == 'gp' and (i*param.n_critic + t) % param.penalty_every == 0
 
 			# Sample fake data
-			z.data.normal_(0, 1)
-			# Volatile requires less memory and make things sightly faster than detach(), so wy not use it with DCGAN?
-			# Simply because we reuse the same fake images, but in WGAN we generate new fake images after training for a while the Discriminator
-			z_volatile = Variable(z.data, volatile = True)
-			x_fake = Variable(G(z_volatile).data)
-			# Discriminator Loss fake
-			errD_fake = D(x_fake)
-			errD_fake = errD_fake.mean()
-			errD_fake.backward(one)
-
-			# Gradient penalty
-			u.uniform_(0, 1)
-			x_both = x.data*u + x_fake.data*(1-u)
-			if param.cuda:
-				x_both = x_both.cuda()
-			# We only want the gradients with respect to x_both
-			x_both = Variable(x_both, requires_grad=True)
-			grad = torch.autograd.grad(outputs=D(x_both), inputs=x_both, grad_outputs=grad_outputs, retain_graph=True, create_graph=True, only_inputs=True)[0]
-			# We need to norm 3 times (over n_colors x image_size x image_size) to get only a vector of size "batch_size"
-			grad_penalty = param.penalty*((grad.norm(2, 1).norm(2,1).norm(2,1) - 1) ** 2).mean()
-			grad_penalty.backward()
+			if param.batch_fakes:
+				x_fake = next(fakes)
+			else:
+				z.data.normal_(0, 1)
+				# Volatile requires less memory and make things sightly faster than detach(), so wy not use it with DCGAN?
+				# Simply because we reuse the same fake images, but in WGAN we generate new fake images after training for a while the Discriminator
+				z_volatile = Variable(z.data, volatile = True)
+				with amp.autocast():
+					x_fake = Variable(G(z_volatile).data)
+
+			if param.fused_critic:
+				u.uniform_(0, 1)
+				# Real and fake images in one forward pass of D (the interpolated ones in their own), one backward for the three losses
+				with contextlib.ExitStack() as stack:
+					if with_penalty:
+						stack.enter_context(penalty_timer)
+					errD_real, errD_fake, grad_penalty = fused_critic(D, x, x_fake, u, param.penalty*param.penalty_every if with_penalty else 0, amp, scalerD)
+					scalerD.scale(errD_fake - errD_real + grad_penalty).backward()
+			else:
+				# Discriminator Loss real
+				with amp.autocast():
+					errD_real = D(x)
+				errD_real = errD_real.float().mean()
+				scalerD.scale(errD_real).backward(one_neg)
+
+				# Discriminator Loss fake
+				with amp.autocast():
+					errD_fake = D(x_fake)
+				errD_fake = errD_fake.float().mean()
+				scalerD.scale(errD_fake).backward(one)
+
+				# Gradient penalty
+				u.uniform_(0, 1)
+				if with_penalty:
+					with penalty_timer:
+						x_both = x.data*u + x_fake.data*(1-u)
+						if param.cuda:
+							x_both = x_both.cuda()
+						# We only want the gradients with respect to x_both
+						x_both = Variable(x_both, requires_grad=True)
+						# With reduced precision, the double-backward is scaled like the losses and the penalty is computed in float32
+						grad = penalty_gradients(D, x_both, grad_outputs, amp, scalerD)
+						# Norm over n_colors x image_size x image_size to get only a vector of size "batch_size"
+						grad_penalty = param.penalty*param.penalty_every*((gradient_norm(grad) - 1) ** 2).mean()
+						scalerD.scale(grad_penalty).backward()
 			# Optimize
-			errD_penalty = errD_fake - errD_real + grad_penalty
+			if with_penalty:
+				penalty_logged = grad_penalty / param.penalty_every
+			errD_penalty = errD_fake - errD_real + penalty_logged
 			errD = errD_fake - errD_real
-			optimizerD.step()
+			scalerD.step(optimizerD)
+			scalerD.update()
 			#print("---")
 			#print(errD_real)
 			#print(errD_fake)
@@ -354,23 +510,50 @@ if __name__ == '__main__':
 
 		# Sample fake data
 		z.data.normal_(0, 1)
-		x_fake = G(z)
-		# Generator Loss
-		errG = D(x_fake)
-		errG = errG.mean()
+		with amp.autocast():
+			x_fake = G(z)
+			# Generator Loss
+			errG = D(x_fake)
+		errG = errG.float().mean()
 		#print(errG)
-		errG.backward(one_neg)
-		optimizerG.step()
+		scalerG.scale(errG).backward(one_neg)
+		scalerG.step(optimizerG)
+		scalerG.update()
+
+		if layout_check is not None:
+			s = layout_check.report()
+			print(s)
+			print(s, file=log_output)
+			layout_check = None
 
-		# Log results so we can see them in TensorBoard after
-		log_value('errD', errD.item(), i)
-		log_value('errD_penalty', errD_penalty.item(), i)
-		log_value('errG', errG.item(), i)
+		# Log results so we can see them in TensorBoard after (kept on the device, written every log_every steps by metrics.py)
+		metrics.log(i, errD=errD, errD_penalty=errD_penalty, errG=errG)
 
 		if i % 50 == 0:
-			print('[i=%d] W_distance: %.4f W_distance_penalty: %.4f Loss_G: %.4f' % (i, errD.item(), errD_penalty.item(), errG.item()))
-			print('[i=%d] W_distance: %.4f W_distance_penalty: %.4f Loss_G: %.4f' % (i, errD.item(), errD_penalty.item(), errG.item()), file=log_output)
+			end = time.time()
+			data_wait = prefetcher.pop_wait()
+			# Seconds per iteration spent on the penalty since the last print
+			penalty_time = penalty_timer.pop() / (i - last_print)
+			last_print = i
+			print('[i=%d] W_distance: %.4f W_distance_penalty: %.4f Loss_G: %.4f time:%.4f data_wait:%.4f penalty_time:%.4f' % (i, errD.item(), errD_penalty.item(), errG.item(), end - start, data_wait, penalty_time))
+			print('[i=%d] W_distance: %.4f W_distance_penalty: %.4f Loss_G: %.4f time:%.4f data_wait:%.4f penalty_time:%.4f' % (i, errD.item(), errD_penalty.item(), errG.item(), end - start, data_wait, penalty_time), file=log_output)
+			for s in checkpoints.pop_reports():
+				print(s)
+				print(s, file=log_output)
 		# Save models
 		if i % 500 == 0:
-			torch.save(G.state_dict(), '%s/run-%d/models/G_%d.pth' % (param.output_folder, run, i))
-			torch.save(D.state_dict(), '%s/run-%d/models/D_%d.pth' % (param.output_folder, run, i))
+			# Copied to host memory here, written in the background
+			# Everything needed to continue after this iteration (--resume), written last
+			# The W_distance of the untrained critic (i=0) is not a measure of G (so it would always be the best one)
+			state = {'G': G.state_dict(), 'D': D.state_dict(), 'optimizerG': optimizerG.state_dict(), 'optimizerD': optimizerD.state_dict(),
+				'scalerG': scalerG.state_dict(), 'scalerD': scalerD.state_dict(), 'z_test': z_test.data, 'seed': param.seed, 'i': i + 1,
+				'penalty_logged': penalty_logged, 'rng': rng_state(param.cuda)}
+			checkpoints.save([(G.state_dict(), '%s/run-%d/models/G_%d.pth' % (param.output_folder, run, i)), (D.state_dict(), '%s/run-%d/models/D_%d.pth' % (param.output_folder, run, i)), (state, training_state_path(base_dir))], step=i, metric=abs(errD.item()) if i > 0 else None)
+
+	# Waiting for the last checkpoint and images
+	checkpoints.close()
+	image_writer.close()
+	metrics.close()
+	for s in checkpoints.pop_reports():
+		print(s)
+		print(s, file=log_output)
@@ -30,7 +30,26 @@ if __name__ == '__main__':
 	parser.add_argument('--cuda', type=bool, default=True, help='enables cuda')
 	parser.add_argument('--n_gpu', type=int, default=1, help='number of GPUs to use')
 	parser.add_argument('--n_workers', type=int, default=2, help='Number of subprocess to use to load the data. Use at least two or the number of cpu cores - 1.')
+	parser.add_argument('--prefetch', type=int, default=2, help='Number of batches loaded in advance by each worker.')
+	parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'], help='Precision of the forward and backward passes of D and G (autocast), fp16 also scales the gradients.')
+	parser.add_argument('--compile', type=bool, default=False, help='Compile D and G with torch.compile (falls back to eager mode if not supported), the first iterations are slower.')
+	parser.add_argument('--memory_format', default='contiguous', choices=['contiguous', 'channels_last'], help='Memory format of the models and of the batches, channels_last (NHWC) convolutions are often faster. The layers getting tensors in another format are reported after the first step.')
+	parser.add_argument('--static_shapes', type=bool, default=False, help='Drop the last incomplete batch of every epoch so that all the steps have the same shapes (for cudnn.benchmark and compiled graphs).')
+	parser.add_argument('--lipschitz', default='clip', choices=['clip', 'spectral'], help='Lipschitz constraint of D, clip: weight clipping, spectral: spectral normalization of the convolutions of D (cheaper).')
+	parser.add_argument('--power_iterations', type=int, default=1, help='Number of power iterations per forward pass of D to estimate the spectral norms (with --lipschitz spectral)')
+	parser.add_argument('--batch_fakes', type=bool, default=False, help='Generate the fake images of all the critic steps in one forward pass of G (or a few if they use more than fakes_memory).')
+	parser.add_argument('--fakes_memory', type=int, default=1024, help='Memory cap in MB of one forward pass of G with --batch_fakes and for the extra images')
+	parser.add_argument('--n_buffers', type=int, default=2, help='Number of batches staged in advance (in pinned memory and on the GPU if cuda) by the background prefetcher.')
+	parser.add_argument('--loader', default='pil', choices=['pil', 'jpeg'], help='pil: ImageFolder decoding the images one by one with PIL, jpeg: batched decoding of the raw JPEG files with torchvision.io.decode_jpeg.')
+	parser.add_argument('--data_cache', default='', help='Memory-mapped image cache made by data_cache.py with the same image_size, used instead of input_folder (ex: ./cache_64.npy)')
 	parser.add_argument('--gen_extra_images', type=int, default=0, help='Every 50 generator iterations, generate additional images with "batch_size" random fake cats.')
+	parser.add_argument('--metrics', nargs='+', default=['tensorboard'], choices=['tensorboard', 'csv', 'jsonl'], help='Where the losses are logged, in the logs folder (ex: --metrics tensorboard csv)')
+	parser.add_argument('--log_every', type=int, default=50, help='The logged losses are the mean, min and max over this number of steps')
+	parser.add_argument('--resume', default='', help='Folder of a stopped run to continue exactly where it stopped, from its last checkpoint (ex: /home/output_folder/run-5). Use the same options.')
+	parser.add_argument('--deterministic', type=bool, default=False, help='Only deterministic algorithms (and no cudnn.benchmark), a resumed run is then identical to an uninterrupted one.')
+	parser.add_argument('--keep_last', type=int, default=0, help='Keep only the last K checkpoints of the models, 0 keeps all of them. The best one is also kept when there is a metric (|W_distance| in the WGANs).')
+	parser.add_argument('--keep_every', type=int, default=0, help='With --keep_last, also keep every M-th checkpoint as an archive.')
+	parser.add_argument('--archive_precision', default='fp32', choices=['fp32', 'fp16', 'bf16'], help='Precision of the archived checkpoints (older than the last K), fp16 or bf16 halves their size.')
 	param = parser.parse_args()
 
 	## Imports
@@ -41,21 +60,36 @@ if __name__ == '__main__':
 
 	# Check folder run-i for all i=0,1,... until it finds run-j which does not exists, then creates a new folder run-j
 	import os
-	run = 0
-	base_dir = f"{param.output_folder}/run-{run}"
-	while os.path.exists(base_dir):
-		run += 1
+	if param.resume != '':
+		# Continue in the folder of the stopped run
+		base_dir = param.resume.rstrip('/')
+		param.output_folder = os.path.dirname(base_dir) or '.'
+		name = os.path.basename(base_dir)
+		if not (name.startswith('run-') and name[len('run-'):].isdigit()):
+			parser.error(f"--resume {param.resume} is not a run folder (run-N, made by a previous training)")
+		# Checked before creating any folder or opening the log of the run
+		from checkpoint import TRAINING_STATE, training_state_path
+		if not os.path.exists(training_state_path(base_dir)):
+			parser.error(f"--resume {param.resume} has no checkpoint to resume from ({TRAINING_STATE} is missing)")
+		run = int(name[len('run-'):])
+		logs_dir = f"{base_dir}/logs"
+		os.makedirs(f"{base_dir}/images/extra", exist_ok=True)
+	else:
+		run = 0
 		base_dir = f"{param.output_folder}/run-{run}"
-	os.mkdir(base_dir)
-	logs_dir = f"{base_dir}/logs"
-	os.mkdir(logs_dir)
-	os.mkdir(f"{base_dir}/images")
-	os.mkdir(f"{base_dir}/models")
-	if param.gen_extra_images > 0:
-		os.mkdir(f"{base_dir}/images/extra")
-
-	# where we save the output
-	log_output = open(f"{logs_dir}/log.txt", 'w')
+		while os.path.exists(base_dir):
+			run += 1
+			base_dir = f"{param.output_folder}/run-{run}"
+		os.mkdir(base_dir)
+		logs_dir = f"{base_dir}/logs"
+		os.mkdir(logs_dir)
+		os.mkdir(f"{base_dir}/images")
+		os.mkdir(f"{base_dir}/models")
+		if param.gen_extra_images > 0:
+			os.mkdir(f"{base_dir}/images/extra")
+
+	# where we save the output (after the log of the stopped run if resuming)
+	log_output = open(f"{logs_dir}/log.txt", 'a' if param.resume != '' else 'w')
 	print(param)
 	print(param, file=log_output)
 
@@ -64,9 +98,9 @@ if __name__ == '__main__':
 	import torch.autograd as autograd
 	from torch.autograd import Variable
 
-	# For plotting the Loss of D and G using tensorboard
-	from tensorboard_logger import configure, log_value
-	configure(logs_dir, flush_secs=5)
+	# For plotting the Loss of D and G using tensorboard (and/or csv, jsonl files), mean, min and max over windows of log_every steps
+	from metrics import Metrics, make_sinks
+	metrics = Metrics(make_sinks(param.metrics, logs_dir), param.log_every)
 
 	import torchvision
 	import torchvision.datasets as dset
@@ -76,12 +110,21 @@ if __name__ == '__main__':
 
 	if param.cuda:
 		import torch.backends.cudnn as cudnn
-		cudnn.benchmark = True
+		cudnn.benchmark = not param.deterministic
+	if param.deterministic:
+		torch.use_deterministic_algorithms(True, warn_only=True)
 
 	# To see images
 	from IPython.display import Image
 	to_img = transf.ToPILImage()
 
+	# Training state of the stopped run (its seed is used again)
+	resume_state = None
+	if param.resume != '':
+		from checkpoint import load_training_state
+		resume_state = load_training_state(base_dir)
+		param.seed = resume_state['seed']
+
 	## Setting seed
 	import random
 	if param.seed is None:
@@ -103,10 +146,33 @@ if __name__ == '__main__':
 	])
 
 	## Importing dataset
-	data = dset.ImageFolder(root=param.input_folder, transform=trans)
-
-	# Loading data in batch
-	dataset = torch.utils.data.DataLoader(data, batch_size=param.batch_size, shuffle=True, num_workers=param.n_workers)
+	from data_stream import DataStream, Prefetcher, shuffled_loader
+	from train_utils import MEMORY_FORMATS
+	# When resuming, the batches already used are skipped
+	start_batch = resume_state['batches'] if resume_state is not None else 0
+	if param.data_cache != '':
+		# Images already decoded and resized, batches are slices of the cache
+		from data_cache import CachedImages, CachedLoader
+		data = CachedImages(param.data_cache, param.image_size)
+		loader = CachedLoader(data, batch_size=param.batch_size, shuffle=True, drop_last=param.static_shapes)
+		loader.skip(start_batch)
+	else:
+		if param.loader == 'jpeg':
+			# Raw bytes, the batches are decoded at once in the workers
+			from jpeg_loader import JpegFiles, JpegDecoder
+			data = JpegFiles(param.input_folder)
+			collate_fn = JpegDecoder(param.image_size)
+		else:
+			data = dset.ImageFolder(root=param.input_folder, transform=trans)
+			collate_fn = None
+
+		# Loading data in batch, reshuffled at every epoch but the loader never ends so the workers are never restarted
+		loader = shuffled_loader(data, param.batch_size, param.seed, n_workers=param.n_workers, prefetch=param.prefetch, pin_memory=param.cuda, collate_fn=collate_fn, start=start_batch)
+	# The critic and generator loops pull from the same stream, len(dataset) is the number of batches in one epoch
+	dataset = DataStream(loader, len(data), param.batch_size)
+	# The next batch is also copied in the background (to the GPU if cuda) while the current one is used
+	prefetcher = Prefetcher(dataset, param.batch_size, cuda=param.cuda, n_buffers=param.n_buffers, memory_format=MEMORY_FORMATS[param.memory_format])
+	data_iter = iter(prefetcher)
 
 	## Models
 
@@ -185,7 +251,9 @@ if __name__ == '__main__':
 				if param.SELU:
 					main.add_module('Middle-SELU [%d]' % i, torch.nn.SELU(inplace=True))
 				else:
-					main.add_module('Middle-BatchNorm2d [%d]' % i, torch.nn.BatchNorm2d(param.D_h_size * (2*mult)))
+					# No BatchNorm with spectral normalization, it would change the Lipschitz constant of D
+					if param.lipschitz != 'spectral':
+						main.add_module('Middle-BatchNorm2d [%d]' % i, torch.nn.BatchNorm2d(param.D_h_size * (2*mult)))
 					main.add_module('Middle-LeakyReLU [%d]' % i, torch.nn.LeakyReLU(0.2, inplace=True))
 				# Size = (D_h_size*(2*i)) x image_size/(2*i) x image_size/(2*i)
 				image_size_new = image_size_new // 2
@@ -228,6 +296,11 @@ if __name__ == '__main__':
 	G.apply(weights_init)
 	D.apply(weights_init)
 
+	# Spectral normalization of the convolutions of D (instead of clipping or the gradient penalty)
+	if param.lipschitz == 'spectral':
+		from train_utils import spectral_norm
+		spectral_norm(D, param.power_iterations)
+
 	# Load existing models
 	if param.G_load != '':
 		G.load_state_dict(torch.load(param.G_load))
@@ -240,7 +313,6 @@ if __name__ == '__main__':
 	print(D, file=log_output)
 
 	# Soon to be variables
-	x = torch.FloatTensor(param.batch_size, param.n_colors, param.image_size, param.image_size)
 	z = torch.FloatTensor(param.batch_size, param.z_size, 1, 1)
 	# This is to see during training, size and values won't change
 	z_test = torch.FloatTensor(param.batch_size, param.z_size, 1, 1).normal_(0, 1)
@@ -251,52 +323,119 @@ if __name__ == '__main__':
 	if param.cuda:
 		G = G.cuda()
 		D = D.cuda()
-		x = x.cuda()
 		z = z.cuda()
 		z_test = z_test.cuda()
 		one, one_neg = one.cuda(), one_neg.cuda()
 
 	# Now Variables
-	x = Variable(x)
 	z = Variable(z)
 	z_test = Variable(z_test)
 
+	# Memory format of the weights (the prefetcher stages the real images in this format and the fake images follow from G)
+	G = G.to(memory_format=MEMORY_FORMATS[param.memory_format])
+	D = D.to(memory_format=MEMORY_FORMATS[param.memory_format])
+
 	# Optimizer
 	optimizerD = torch.optim.RMSprop(D.parameters(), lr=param.lr_D)
 	optimizerG = torch.optim.RMSprop(G.parameters(), lr=param.lr_G)
 
+	# Mixed precision (autocast) and gradient scaling (only with fp16)
+	from train_utils import Precision
+	amp = Precision(param.precision, param.cuda)
+	scalerD = amp.scaler()
+	scalerG = amp.scaler()
+
+	# Compiled D and G (warmed up on a batch of zeros to measure the compilation time)
+	if param.compile:
+		from train_utils import compile_model
+		z_example = torch.zeros(param.batch_size, param.z_size, 1, 1)
+		x_example = torch.zeros(param.batch_size, param.n_colors, param.image_size, param.image_size).contiguous(memory_format=MEMORY_FORMATS[param.memory_format])
+		if param.cuda:
+			z_example = z_example.cuda()
+			x_example = x_example.cuda()
+		for model, example, name in [(G, z_example, 'G'), (D, x_example, 'D')]:
+			s = compile_model(model, example, amp, name)
+			print(s)
+			print(s, file=log_output)
+
+	# Layers getting tensors in another memory format during the first step (only in eager mode)
+	layout_check = None
+	if param.memory_format != 'contiguous' and not param.compile:
+		from train_utils import LayoutCheck
+		layout_check = LayoutCheck({'G': G, 'D': D}, MEMORY_FORMATS[param.memory_format])
+
+	# Weight clipping in a few multi-tensor operations and the parameters of G for its backward (made once)
+	from train_utils import WeightClipper
+	clip_weights = WeightClipper(D, param.clip)
+	G_params = list(G.parameters())
+
+	# Fake images of the critic steps generated together
+	from train_utils import FakeBatches, ImageWriter
+	if param.batch_fakes:
+		fake_batches = FakeBatches(G, param.z_size, amp, param.fakes_memory)
+		s = f"[fakes] up to {fake_batches.chunk_size(param.batch_size)} critic steps of fake images per forward pass of G"
+		print(s)
+		print(s, file=log_output)
+
+	# Sample images encoded and written by background threads
+	image_writer = ImageWriter()
+	extra_images = FakeBatches(G, param.z_size, amp, param.fakes_memory)
+
+	# Models saved by a background thread
+	from checkpoint import CheckpointStore, CheckpointWriter, rng_state, training_state_path
+	# Old checkpoints deleted or archived according to --keep_last and --keep_every, listed in models/index.json
+	checkpoints = CheckpointWriter(CheckpointStore(f"{base_dir}/models", param.keep_last, param.keep_every, param.archive_precision))
+
 	## Fitting model
 
+	# Continuing the stopped run after its last checkpoint (possibly in the middle of an epoch)
 	gen_iterations = 0
-	for epoch in range(param.n_epoch):
-
-		# Fake images saved
-		if gen_iterations % 50 == 0:
-			fake_test = G(z_test)
-			vutils.save_image(fake_test.data, '%s/run-%d/images/fake_samples_iter%03d.png' % (param.output_folder, run, gen_iterations/50), normalize=True)
-			for ext in range(param.gen_extra_images):
-				z_extra = torch.FloatTensor(param.batch_size, param.z_size, 1, 1).normal_(0, 1)
-				if param.cuda:
-					z_extra = z_extra.cuda()
-				fake_test = G(Variable(z_extra))
-				vutils.save_image(fake_test.data, '%s/run-%d/images/extra/fake_samples_iter%03d_extra%01d.png' % (param.output_folder, run, gen_iterations/50, ext), normalize=True)
-
-		# Setting up iterable
-		i = 0
-		data_iter = iter(dataset)
+	start_epoch = 0
+	start_i = 0
+	if resume_state is not None:
+		from checkpoint import set_rng_state
+		G.load_state_dict(resume_state['G'])
+		D.load_state_dict(resume_state['D'])
+		optimizerG.load_state_dict(resume_state['optimizerG'])
+		optimizerD.load_state_dict(resume_state['optimizerD'])
+		scalerG.load_state_dict(resume_state['scalerG'])
+		scalerD.load_state_dict(resume_state['scalerD'])
+		z_test.data.copy_(resume_state['z_test'])
+		gen_iterations = resume_state['gen_iterations']
+		start_epoch = resume_state['epoch']
+		start_i = resume_state['i']
+		set_rng_state(resume_state['rng'])
+		print(f"Resuming {base_dir} at generator iteration {gen_iterations}")
+		print(f"Resuming {base_dir} at generator iteration {gen_iterations}", file=log_output)
+
+	for epoch in range(start_epoch, param.n_epoch):
+
+		# Setting up iterable (the stream continues where the previous epoch stopped, or where the stopped run was)
+		i = start_i if epoch == start_epoch else 0
+
+		# Fake images saved (not in the middle of a resumed epoch, they were at its start)
+		if gen_iterations % 50 == 0 and i == 0:
+			with torch.no_grad(), amp.autocast():
+				fake_test = G(z_test)
+			image_writer.save(fake_test, '%s/run-%d/images/fake_samples_iter%03d.png' % (param.output_folder, run, gen_iterations/50))
+			# Extra images in a few no-grad forward passes of G
+			if param.gen_extra_images > 0:
+				for ext, fake_extra in enumerate(extra_images.generate(param.gen_extra_images, param.batch_size)):
+					image_writer.save(fake_extra, '%s/run-%d/images/extra/fake_samples_iter%03d_extra%01d.png' % (param.output_folder, run, gen_iterations/50, ext))
 
 
 		while i < len(dataset):
 
-			for p in D.parameters():
-				p.requires_grad = True
-
 			# "Trick" used in the Wassertein GAN paper for more stable convergence
 			if gen_iterations < 25 or gen_iterations % 500 == 0:
 				N_critic = 100
 			else:
 				N_critic = param.n_critic
 
+			# Fake images of all the critic steps in a few forward passes of G
+			if param.batch_fakes:
+				fakes = fake_batches.generate(min(N_critic, len(dataset) - i), param.batch_size)
+
 			t = 0
 			while t < N_critic and i < len(dataset):
 
@@ -307,35 +446,41 @@ if __name__ == '__main__':
 				D.zero_grad()
 
 				# Clip weights
-				for p in D.parameters():
-					p.data.clamp_(-param.clip, param.clip)
+				if param.lipschitz == 'clip':
+					clip_weights()
 
 				# Sample real data
 				real_images, labels = data_iter.__next__()
 				# Mostly necessary for the last one because if N might not be a multiple of batch_size
 				current_batch_size = real_images.size(0)
-				if param.cuda:
-					real_images = real_images.cuda()
-				# Transfer batch of images to x
-				x.data.resize_as_(real_images).copy_(real_images)
+				# The prefetcher already transferred the batch of images (to the GPU if cuda) to its buffer
+				x = Variable(real_images)
 				# Discriminator Loss real
-				errD_real = D(x)
-				errD_real.backward(one)
+				with amp.autocast():
+					errD_real = D(x).float()
+				scalerD.scale(errD_real).backward(one)
 
 				# Sample fake data
-				# Note that z might be bigger than x here, this is done like this in Wassertein paper, but it could probably be changed
-				z.data.resize_(current_batch_size, param.z_size, 1, 1).normal_(0, 1)
-				# Volatile requires less memory and make things sightly faster than detach(), so wy not use it with DCGAN?
-				# Simply because we reuse the same fake images, but in WGAN we generate new fake images after training for a while the Discriminator
-				z_volatile = Variable(z.data, volatile = True)
-				x_fake = Variable(G(z_volatile).data)
-				# Discriminator Loss fake
-				errD_fake = D(x_fake)
-				errD_fake.backward(one_neg)
+				if param.batch_fakes:
+					x_fake = next(fakes)[:current_batch_size]
+				else:
+					# Note that z might be bigger than x here, this is done like this in Wassertein paper, but it could probably be changed
+					# (a view of the preallocated z, no reallocation for a smaller batch)
+					z_batch = z[:current_batch_size].normal_(0, 1)
+					# Volatile requires less memory and make things sightly faster than detach(), so wy not use it with DCGAN?
+					# Simply because we reuse the same fake images, but in WGAN we generate new fake images after training for a while the Discriminator
+					z_volatile = Variable(z_batch.data, volatile = True)
+					with amp.autocast():
+						x_fake = Variable(G(z_volatile).data)
+				with amp.autocast():
+					# Discriminator Loss fake
+					errD_fake = D(x_fake).float()
+				scalerD.scale(errD_fake).backward(one_neg)
 
 				# Optimize
 				errD = (errD_real - errD_fake)
-				optimizerD.step()
+				scalerD.step(optimizerD)
+				scalerD.update()
 
 
 				# Iterate up
@@ -345,30 +490,55 @@ if __name__ == '__main__':
 			########################
 			# (2) Update G network #
 			########################
-			for p in D.parameters():
-				p.requires_grad = False
-
 			G.zero_grad()
 
 			# Sample fake data
-			z.data.resize_(param.batch_size, param.z_size, 1, 1).normal_(0, 1)
-			x_fake = G(z)
-			# Generator Loss
-			errG = D(x_fake)
-			errG.backward(one)
-			optimizerG.step()
-
-			# Log results so we can see them in TensorBoard after
-			log_value('errD', -errD.data[0], gen_iterations)
-			log_value('errG', errG.data[0], gen_iterations)
+			z.data.normal_(0, 1)
+			with amp.autocast():
+				x_fake = G(z)
+				# Generator Loss
+				errG = D(x_fake).float()
+			# Only the gradients of G are computed (D stays trainable, no requires_grad switching)
+			scalerG.scale(errG).backward(one, inputs=G_params)
+			scalerG.step(optimizerG)
+			scalerG.update()
+
+			if layout_check is not None:
+				s = layout_check.report()
+				print(s)
+				print(s, file=log_output)
+				layout_check = None
+
+			# Log results so we can see them in TensorBoard after (kept on the device, written every log_every steps by metrics.py)
+			metrics.log(gen_iterations, errD=-errD.data, errG=errG.data)
 
 			gen_iterations = gen_iterations + 1
 
 			if gen_iterations % 50 == 0:
 				end = time.time()
-				print('[%d] W_distance: %.4f Loss_G: %.4f time:%.4f' % (gen_iterations, -errD.data[0], errG.data[0], end - start))
-				print('[%d] W_distance: %.4f Loss_G: %.4f time:%.4f' % (gen_iterations, -errD.data[0], errG.data[0], end - start), file=log_output)
+				data_wait = prefetcher.pop_wait()
+				print('[%d] W_distance: %.4f Loss_G: %.4f time:%.4f data_wait:%.4f' % (gen_iterations, -errD.data[0], errG.data[0], end - start, data_wait))
+				print('[%d] W_distance: %.4f Loss_G: %.4f time:%.4f data_wait:%.4f' % (gen_iterations, -errD.data[0], errG.data[0], end - start, data_wait), file=log_output)
+				for s in checkpoints.pop_reports():
+					print(s)
+					print(s, file=log_output)
 			# Save models
 			if gen_iterations % 500 == 0:
-				torch.save(G.state_dict(), '%s/run-%d/models/G_%d.pth' % (param.output_folder, run, gen_iterations/50))
-				torch.save(D.state_dict(), '%s/run-%d/models/D_%d.pth' % (param.output_folder, run, gen_iterations/50))
+				# Copied to host memory here, written in the background
+				# Everything needed to continue from here (--resume), written last
+				state = {'G': G.state_dict(), 'D': D.state_dict(), 'optimizerG': optimizerG.state_dict(), 'optimizerD': optimizerD.state_dict(),
+					'scalerG': scalerG.state_dict(), 'scalerD': scalerD.state_dict(), 'z_test': z_test.data, 'seed': param.seed,
+					'epoch': epoch, 'i': i, 'gen_iterations': gen_iterations, 'batches': epoch*len(dataset) + i, 'rng': rng_state(param.cuda)}
+				checkpoints.save([(G.state_dict(), '%s/run-%d/models/G_%d.pth' % (param.output_folder, run, gen_iterations/50)), (D.state_dict(), '%s/run-%d/models/D_%d.pth' % (param.output_folder, run, gen_iterations/50)), (state, training_state_path(base_dir))], step=gen_iterations, metric=abs(errD.item()))
+
+		# Data loading throughput of the last complete epoch
+		print(dataset.summary())
+		print(dataset.summary(), file=log_output)
+
+	# Waiting for the last checkpoint and images
+	checkpoints.close()
+	image_writer.close()
+	metrics.close()
+	for s in checkpoints.pop_reports():
+		print(s)
+		print(s, file=log_output)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+## Benchmarks of the training pipeline
+# Every benchmark is a sub-command, use the python command: python benchmark.py <benchmark> --help
+
+import argparse
+import time
+
+import torch
+
+# Images per second over n_batches batches, after a few warm-up batches (starting the workers, etc.)
+def images_per_sec(batches, n_batches, n_warmup=3):
+	iterator = iter(batches)
+	for k in range(n_warmup):
+		next(iterator)
+	n_images = 0
+	start = time.time()
+	for k in range(n_batches):
+		images = next(iterator)[0]
+		n_images += images.size(0)
+	return n_images / (time.time() - start)
+
+## Data loading: PIL ImageFolder vs batched JPEG decoding vs memory-mapped cache
+def bench_loader(param):
+	import torchvision.datasets as dset
+	import torchvision.transforms as transf
+	from data_stream import shuffled_loader
+	from jpeg_loader import JpegFiles, JpegDecoder
+
+	# Same transformations as in the trainers
+	trans = transf.Compose([
+		transf.Resize((param.image_size, param.image_size)),
+		transf.ToTensor(),
+		transf.Normalize(mean = [0.5, 0.5, 0.5], std = [0.5, 0.5, 0.5])
+	])
+	loaders = {}
+	loaders['pil'] = shuffled_loader(dset.ImageFolder(root=param.input_folder, transform=trans), param.batch_size, 1, n_workers=param.n_workers)
+	loaders['jpeg'] = shuffled_loader(JpegFiles(param.input_folder), param.batch_size, 1, n_workers=param.n_workers, collate_fn=JpegDecoder(param.image_size))
+	if param.data_cache != '':
+		from data_cache import CachedImages, CachedLoader
+		from data_stream import DataStream
+		data = CachedImages(param.data_cache, param.image_size)
+		loaders['cache'] = DataStream(CachedLoader(data, param.batch_size), len(data), param.batch_size)
+	# pil and jpeg decode in n_workers subprocess, the cache is sliced in the main process
+	print(f"{param.n_workers} workers, batches of {param.batch_size} images of size {param.image_size}x{param.image_size}")
+	results = {}
+	for name, loader in loaders.items():
+		results[name] = images_per_sec(loader, param.n_batches)
+		print(f"{name}: {results[name]:.1f} images/s, x{results[name] / results['pil']:.2f}")
+
+## Training speed and memory of a training script with different options
+# Every variant runs the script with the common arguments plus its own options. The seconds per 50 iterations are measured
+# from the 'time:' of the progress lines (so the start-up and the first 50 iterations don't count),
+# the peak memory is the maximum resident set size of the training process (not of its data loading workers).
+# ex: python benchmark.py train --script DCGAN.py --variants "" "--compile True" -- --n_epoch 1 --cuda= --input_folder ./images
+def bench_train(param):
+	import os
+	import re
+	import subprocess
+	import sys
+	import tempfile
+
+	print(f"{param.script} {' '.join(param.args)}")
+	results = []
+	for variant in param.variants:
+		label = variant if variant != '' else '(default options)'
+		output_folder = tempfile.mkdtemp()
+		command = [sys.executable, param.script] + param.args + variant.split() + ['--output_folder', output_folder]
+		process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+		times = []
+		for line in process.stdout:
+			match = re.search(r'time:([0-9.]+)', line)
+			if match is not None:
+				times.append(float(match.group(1)))
+		# Resource usage of this process only
+		pid, status, usage = os.wait4(process.pid, 0)
+		if status != 0 or len(times) < 2:
+			print(f"{label}: failed or too short (need at least 2 progress lines), run it to see the output: {' '.join(command)}")
+			continue
+		sec_per_50 = (times[-1] - times[0]) / (len(times) - 1)
+		# ru_maxrss is in kilobytes on Linux
+		peak_mb = usage.ru_maxrss / 1024
+		results.append((variant, sec_per_50, peak_mb))
+		print(f"{label}: {sec_per_50:.4f}s per 50 iterations, peak memory {peak_mb:.1f} MB, x{results[0][1] / sec_per_50:.2f} speed")
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(dest='benchmark')
+	subparsers.required = True
+
+	loader = subparsers.add_parser('loader', help='Images per second of the data loading backends.')
+	loader.add_argument('--input_folder', default='./images', help='input folder')
+	loader.add_argument('--data_cache', default='', help='Also measure this cache made by data_cache.py')
+	loader.add_argument('--image_size', type=int, default=64)
+	loader.add_argument('--batch_size', type=int, default=64)
+	loader.add_argument('--n_workers', type=int, default=2)
+	loader.add_argument('--n_batches', type=int, default=50)
+	loader.set_defaults(run=bench_loader)
+
+	train = subparsers.add_parser('train', help='Seconds per 50 iterations and peak memory of a training script with different options.')
+	train.add_argument('--script', default='DCGAN.py', help='DCGAN.py, LSGAN.py, WGAN.py or WGAN-GP.py')
+	train.add_argument('--variants', nargs='+', default=[''], help='Options of each variant, ex: "--precision fp32" "--precision bf16"')
+	train.add_argument('args', nargs=argparse.REMAINDER, help='Arguments given to every variant (after --)')
+	train.set_defaults(run=bench_train)
+
+	param = parser.parse_args()
+	if param.benchmark == 'train' and len(param.args) > 0 and param.args[0] == '--':
+		param.args = param.args[1:]
+	torch.manual_seed(1)
+	param.run(param)
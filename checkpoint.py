@@ -0,0 +1,210 @@
+## Checkpoints written in the background
+# torch.save of the models blocks the training loop for the whole serialization and write (seconds on network storage).
+# Instead, the state dicts are copied to host memory on the training thread (fast) and a background thread serializes them
+# and writes every file atomically (temporary file then rename), so a crash never leaves a truncated checkpoint.
+# Only one checkpoint is in flight: saving again before the previous one is written waits for it (backpressure, bounded memory).
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy
+import torch
+
+# Copy of a state dict (or any nested dict/list of tensors) in host memory, independent from the training which continues
+def snapshot(state):
+	if isinstance(state, torch.Tensor):
+		return state.detach().to('cpu', copy=True)
+	if isinstance(state, dict):
+		return type(state)((k, snapshot(v)) for k, v in state.items())
+	if isinstance(state, (list, tuple)):
+		return type(state)(snapshot(v) for v in state)
+	return state
+
+# Atomic torch.save: the file is either the previous one or the complete new one
+def atomic_save(state, path):
+	tmp = f"{path}.tmp"
+	with open(tmp, 'wb') as f:
+		torch.save(state, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp, path)
+
+## Which model checkpoints are kept
+# With keep_last=K, only the last K checkpoints are kept, plus every M-th one (keep_every=M) and the best one (lowest metric).
+# Those older ones are archives, they can be converted to half precision (load_state_dict converts them back).
+# models_dir/index.json lists the checkpoints which are kept, the latest and the best one, so tools don't need to parse the file names.
+ARCHIVE_DTYPES = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+INDEX = 'index.json'
+
+# Copy of a state dict with its floating point tensors in dtype
+def cast_state(state, dtype):
+	if isinstance(state, torch.Tensor):
+		return state.to(dtype) if state.is_floating_point() else state
+	if isinstance(state, dict):
+		return type(state)((k, cast_state(v, dtype)) for k, v in state.items())
+	if isinstance(state, (list, tuple)):
+		return type(state)(cast_state(v, dtype) for v in state)
+	return state
+
+class CheckpointStore(object):
+	# keep_last=0 keeps everything
+	def __init__(self, models_dir, keep_last=0, keep_every=0, archive_precision='fp32'):
+		self.models_dir = os.path.abspath(models_dir)
+		self.keep_last = keep_last
+		self.keep_every = keep_every
+		self.archive_precision = archive_precision
+		self.index_path = os.path.join(self.models_dir, INDEX)
+		# The index of a resumed run is continued
+		self.checkpoints = []
+		self.count = 0
+		self.best = None
+		if os.path.exists(self.index_path):
+			with open(self.index_path) as f:
+				index = json.load(f)
+			self.checkpoints = index['checkpoints']
+			self.count = index['count']
+			# The best one is also in the list (if kept)
+			self.best = next((c for c in self.checkpoints if index['best'] is not None and c['number'] == index['best']['number']), index['best'])
+
+	def is_model_file(self, path):
+		return os.path.dirname(os.path.abspath(path)) == self.models_dir
+
+	# Adds a written checkpoint (files: its paths in models_dir), then deletes or archives the old ones. Returns a message.
+	def add(self, step, files, metric=None):
+		# A number in the index (not a tensor, which json can't write)
+		if metric is not None:
+			metric = float(metric)
+		checkpoint = {'number': self.count, 'step': step, 'files': [os.path.basename(path) for path in files], 'metric': metric, 'precision': 'fp32'}
+		self.count += 1
+		self.checkpoints.append(checkpoint)
+		if metric is not None and (self.best is None or metric < self.best['metric']):
+			self.best = checkpoint
+		deleted, archived = self._retain()
+		self._write_index()
+		return f"kept {len(self.checkpoints)}, deleted {deleted}, archived {archived}"
+
+	def _retain(self):
+		deleted, archived = 0, 0
+		if self.keep_last <= 0:
+			return deleted, archived
+		kept = []
+		for k, checkpoint in enumerate(self.checkpoints):
+			recent = k >= len(self.checkpoints) - self.keep_last
+			every = self.keep_every > 0 and checkpoint['number'] % self.keep_every == 0
+			best = self.best is not None and checkpoint['number'] == self.best['number']
+			if recent:
+				kept.append(checkpoint)
+			elif every or best:
+				if checkpoint['precision'] != self.archive_precision and ARCHIVE_DTYPES[self.archive_precision] is not None:
+					for name in checkpoint['files']:
+						path = os.path.join(self.models_dir, name)
+						atomic_save(cast_state(torch.load(path, map_location='cpu'), ARCHIVE_DTYPES[self.archive_precision]), path)
+					checkpoint['precision'] = self.archive_precision
+					archived += 1
+				kept.append(checkpoint)
+			else:
+				for name in checkpoint['files']:
+					path = os.path.join(self.models_dir, name)
+					if os.path.exists(path):
+						os.remove(path)
+				deleted += 1
+		self.checkpoints = kept
+		return deleted, archived
+
+	def _write_index(self):
+		latest = self.checkpoints[-1] if len(self.checkpoints) > 0 else None
+		index = {'latest': latest, 'best': self.best, 'count': self.count, 'checkpoints': self.checkpoints}
+		tmp = f"{self.index_path}.tmp"
+		with open(tmp, 'w') as f:
+			json.dump(index, f, indent=1)
+		os.replace(tmp, self.index_path)
+
+class CheckpointWriter(object):
+	# store: CheckpointStore of the model files (optional)
+	def __init__(self, store=None):
+		self.store = store
+		self.jobs = queue.Queue()
+		self.idle = threading.Event()
+		self.idle.set()
+		self.error = None
+		# Messages of the finished checkpoints, see pop_reports()
+		self.reports = []
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	# files: list of (state, path), saved as one checkpoint. Returns once the states are copied to host memory.
+	# step and metric (lower is better, optional) are recorded in the index of the store.
+	def save(self, files, step=None, metric=None):
+		start = time.time()
+		# Backpressure: the previous checkpoint must be written first
+		self.idle.wait()
+		waited = time.time() - start
+		self._raise()
+		snapshots = [(snapshot(state), path) for state, path in files]
+		self.idle.clear()
+		self.jobs.put((snapshots, step, metric, waited, time.time() - start))
+
+	def _run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			snapshots, step, metric, waited, blocked = job
+			start = time.time()
+			try:
+				for state, path in snapshots:
+					atomic_save(state, path)
+				report = f"[checkpoint] {os.path.basename(snapshots[-1][1])}: training blocked {blocked:.4f}s (waited {waited:.4f}s for the previous one), written in {time.time() - start:.4f}s"
+				if self.store is not None:
+					report += f", {self.store.add(step, [path for state, path in snapshots if self.store.is_model_file(path)], metric)}"
+				self.reports.append(report)
+			except Exception as e:
+				self.error = e
+			self.idle.set()
+
+	def _raise(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+	# Messages of the checkpoints written since the last call
+	def pop_reports(self):
+		reports, self.reports = self.reports, []
+		return reports
+
+	# Waits for the last checkpoint (at the end of the training)
+	def close(self):
+		self.idle.wait()
+		self.jobs.put(None)
+		self.thread.join()
+		self._raise()
+
+## Resuming a training
+# Along with the models, every checkpoint saves the whole training state (models, optimizers, gradient scalers, random generators,
+# counters, z_test) in the run folder, written last so that it is always the state of the last complete checkpoint.
+TRAINING_STATE = 'training_state.pth'
+
+def training_state_path(run_dir):
+	return os.path.join(run_dir, TRAINING_STATE)
+
+def load_training_state(run_dir):
+	path = training_state_path(run_dir)
+	if not os.path.exists(path):
+		raise FileNotFoundError(f"No checkpoint to resume from in {run_dir} ({TRAINING_STATE} is missing)")
+	# Our own file: it contains the states of the python and numpy random generators, not only tensors
+	return torch.load(path, map_location='cpu', weights_only=False)
+
+# States of the random generators (python, numpy, torch and cuda)
+def rng_state(cuda):
+	return {'python': random.getstate(), 'numpy': numpy.random.get_state(), 'torch': torch.get_rng_state(), 'cuda': torch.cuda.get_rng_state_all() if cuda else None}
+
+def set_rng_state(state):
+	random.setstate(state['python'])
+	numpy.random.set_state(state['numpy'])
+	torch.set_rng_state(state['torch'])
+	if state['cuda'] is not None:
+		torch.cuda.set_rng_state_all(state['cuda'])
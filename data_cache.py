@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+## Pre-decoded, memory-mapped dataset cache
+# Decoding the JPEGs and resizing them at every epoch is the bottleneck on CPU-only machines.
+# Instead we decode and resize the images once and store them as one contiguous uint8 array
+# of size N x n_colors x image_size x image_size (.npy format so the shape is stored in the header).
+# The trainers then memory-map it with --data_cache and only have to convert each batch to [-1,1].
+# The rows are shuffled once when the cache is written (seeded permutation, saved next to it in <cache>_order.npy:
+# row k of the cache is image order[k] of the ImageFolder), so that any contiguous slice is a random sample of the dataset.
+# To build the cache, use the python command: python data_cache.py --input_folder ./images --image_size 64 --output ./cache_64.npy
+
+import os
+
+import numpy
+import torch
+
+# PIL image to uint8 tensor of size n_colors x image_size x image_size (not a lambda so that it works with Windows subprocesses)
+def pil_to_uint8(img):
+	return torch.from_numpy(numpy.asarray(img, dtype=numpy.uint8).transpose(2, 0, 1).copy())
+
+# File of the permutation of the rows of a cache (or of a shard of preprocess_cat_dataset.py)
+def order_path(path):
+	return os.path.splitext(path)[0] + '_order.npy'
+
+def build_cache(input_folder, output, image_size, batch_size=256, n_workers=2, seed=0):
+	import torchvision.datasets as dset
+	import torchvision.transforms as transf
+
+	# Same resizing as in the trainers, but we stop before ToTensor so that we keep the uint8 pixels
+	trans = transf.Compose([
+		transf.Resize((image_size, image_size)),
+		pil_to_uint8
+	])
+	data = dset.ImageFolder(root=input_folder, transform=trans)
+	loader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=False, num_workers=n_workers)
+
+	# Image i of the folder goes to row position[i]
+	order = numpy.random.RandomState(seed).permutation(len(data))
+	position = numpy.argsort(order)
+	# Preallocate the whole array on disk and fill it batch by batch
+	images = numpy.lib.format.open_memmap(output, mode='w+', dtype=numpy.uint8, shape=(len(data), 3, image_size, image_size))
+	n = 0
+	for batch, labels in loader:
+		images[position[n:n + batch.size(0)]] = batch.numpy()
+		n += batch.size(0)
+	images.flush()
+	del images
+	numpy.save(order_path(output), order)
+	return n
+
+# Pixels to [-1,1], same as ToTensor followed by Normalize(mean = [0.5, 0.5, 0.5], std = [0.5, 0.5, 0.5])
+def normalize_batch(images):
+	return images.float().div_(127.5).sub_(1)
+
+# Dataset version of the cache, can be used anywhere the ImageFolder was used (ex: data[i][0] in WGAN-GP)
+class CachedImages(torch.utils.data.Dataset):
+	def __init__(self, path, image_size=None):
+		self.path = path
+		# Copy-on-write mapping, nothing is read from disk until it is used and torch.from_numpy doesn't complain about read-only arrays
+		self.images = numpy.load(path, mmap_mode='c')
+		if image_size is not None and self.images.shape[2:] != (image_size, image_size):
+			raise ValueError(f"Cache {path} contains {self.images.shape[2]}x{self.images.shape[3]} images but image_size is {image_size}")
+
+	# Pickling a memmap copies the whole array, so DataLoader workers map the file again instead
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['images']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.images = numpy.load(self.path, mmap_mode='c')
+
+	def __len__(self):
+		return self.images.shape[0]
+
+	def __getitem__(self, i):
+		# Label is always 0, all cats are in the same class
+		return normalize_batch(torch.from_numpy(self.images[i])), 0
+
+# DataLoader replacement which reads the batches directly from the memory-mapped array (no worker, no collate of single images).
+# Same shuffle as the DataLoader's shuffle=True: a new permutation of the rows is drawn at every epoch and each batch gathers
+# its rows from it (sorted, so the mapped file is read forward). Without shuffle the batches are contiguous slices of the array.
+class CachedLoader(object):
+	def __init__(self, data, batch_size, shuffle=True, drop_last=False, seed=None):
+		self.data = data
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.drop_last = drop_last
+		self.generator = torch.Generator()
+		self.generator.manual_seed(torch.initial_seed() if seed is None else seed)
+		# First batch of the next pass (see skip)
+		self.start = 0
+
+	# Rows of the next pass, None when they are read in order
+	def _permutation(self):
+		if self.shuffle:
+			return torch.randperm(len(self.data), generator=self.generator).numpy()
+		return None
+
+	# Continues from the n_batches-th batch of the successive passes (to resume a training where it stopped)
+	def skip(self, n_batches):
+		for k in range(n_batches // len(self)):
+			self._permutation()
+		self.start = n_batches % len(self)
+
+	def __len__(self):
+		if self.drop_last:
+			return len(self.data) // self.batch_size
+		return (len(self.data) + self.batch_size - 1) // self.batch_size
+
+	def __iter__(self):
+		images = self.data.images
+		n = images.shape[0]
+		rows = self._permutation()
+		first, self.start = self.start, 0
+		for k in range(first, len(self)):
+			s, e = k*self.batch_size, min((k+1)*self.batch_size, n)
+			if rows is None:
+				batch = torch.from_numpy(images[s:e])
+			else:
+				batch = torch.from_numpy(images[numpy.sort(rows[s:e])])
+			# Only converted to float once per batch
+			yield normalize_batch(batch), torch.zeros(e - s, dtype=torch.long)
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--input_folder', default='./images', help='input folder (same as in the trainers)')
+	parser.add_argument('--image_size', type=int, default=64)
+	parser.add_argument('--output', default='', help='output file (default: cache_<image_size>.npy)')
+	parser.add_argument('--batch_size', type=int, default=256)
+	parser.add_argument('--n_workers', type=int, default=2, help='Number of subprocess to use to decode the images.')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the permutation of the rows')
+	param = parser.parse_args()
+
+	import time
+	start = time.time()
+	output = param.output or f"cache_{param.image_size}.npy"
+	n = build_cache(param.input_folder, output, param.image_size, batch_size=param.batch_size, n_workers=param.n_workers, seed=param.seed)
+	print(f"Cached {n} images of size {param.image_size}x{param.image_size} in {output} time:{time.time() - start:.4f}")
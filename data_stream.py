@@ -0,0 +1,244 @@
+## Infinite streams of training batches
+# The trainers which don't go through the dataset epoch by epoch (WGAN-GP) or whose critic pulls batches at its own pace (WGAN) only need "the next batch".
+# These helpers let the DataLoader workers decode the images in parallel and ahead of time so that the training loop never waits on them.
+
+import multiprocessing
+import queue
+import threading
+import time
+import numpy
+import torch
+
+# Start method of the DataLoader workers. The trainers run background threads (prefetcher, image, checkpoint and metrics writers):
+# a worker forked while one of them holds a lock (ex: the import lock of a PIL plugin) would hang on it, so the workers are started
+# from a forkserver (a clean single-threaded process) where it exists, with the platform default otherwise (spawn on Windows).
+def worker_context(n_workers):
+	if n_workers == 0 or 'forkserver' not in multiprocessing.get_all_start_methods():
+		return None
+	return multiprocessing.get_context('forkserver')
+
+# Infinite batch sampler, each batch contains batch_size different images (numpy.random.choice(..., replace=False))
+# but the batches are independent from each other (so the same image can appear in consecutive batches).
+# The indexes only depend on the seed so the batches are the same whatever the number of workers.
+# start: number of batches to skip (to resume a training where it stopped)
+class RandomBatchSampler(torch.utils.data.Sampler):
+	def __init__(self, n, batch_size, seed, start=0):
+		self.n = n
+		self.batch_size = batch_size
+		self.seed = seed
+		self.start = start
+
+	def __iter__(self):
+		random_state = numpy.random.RandomState(self.seed)
+		for k in range(self.start):
+			random_state.choice(self.n, size=self.batch_size, replace=False)
+		while True:
+			yield random_state.choice(self.n, size=self.batch_size, replace=False).tolist()
+
+# Generator of random batches of images (without the labels), decoded by n_workers subprocess with prefetch batches ready per worker
+def random_batches(data, batch_size, seed, n_workers=2, prefetch=2, pin_memory=False, collate_fn=None, start=0):
+	sampler = RandomBatchSampler(len(data), batch_size, seed, start)
+	# The seeds of the workers come from this generator, not from the global one (the loader starts in the background)
+	generator = torch.Generator()
+	generator.manual_seed(seed)
+	if n_workers > 0:
+		loader = torch.utils.data.DataLoader(data, batch_sampler=sampler, num_workers=n_workers, prefetch_factor=prefetch, pin_memory=pin_memory, collate_fn=collate_fn, generator=generator, multiprocessing_context=worker_context(n_workers))
+	else:
+		loader = torch.utils.data.DataLoader(data, batch_sampler=sampler, pin_memory=pin_memory, collate_fn=collate_fn, generator=generator)
+	for images, labels in loader:
+		yield images
+
+# Infinite sampler which chains a new random permutation of the dataset at every epoch
+# start: number of indexes to skip (to resume a training where it stopped)
+class EpochShuffleSampler(torch.utils.data.Sampler):
+	def __init__(self, n, seed, start=0):
+		self.n = n
+		self.seed = seed
+		self.start = start
+
+	def __iter__(self):
+		generator = torch.Generator()
+		generator.manual_seed(self.seed)
+		# Whole permutations skipped without listing them
+		for k in range(self.start // self.n):
+			torch.randperm(self.n, generator=generator)
+		skip = self.start % self.n
+		while True:
+			for i in torch.randperm(self.n, generator=generator).tolist()[skip:]:
+				yield i
+			skip = 0
+
+# DataLoader which never ends, the workers are started once and keep loading the first batches of the next epoch
+# while the last batches of the current epoch are used (a batch can contain images of two consecutive epochs)
+def shuffled_loader(data, batch_size, seed, n_workers=2, prefetch=2, pin_memory=False, collate_fn=None, start=0):
+	sampler = EpochShuffleSampler(len(data), seed, start*batch_size)
+	# The seeds of the workers come from this generator, not from the global one
+	generator = torch.Generator()
+	generator.manual_seed(seed)
+	if n_workers > 0:
+		return torch.utils.data.DataLoader(data, batch_size=batch_size, sampler=sampler, num_workers=n_workers, prefetch_factor=prefetch, pin_memory=pin_memory, collate_fn=collate_fn, generator=generator, multiprocessing_context=worker_context(n_workers))
+	return torch.utils.data.DataLoader(data, batch_size=batch_size, sampler=sampler, pin_memory=pin_memory, collate_fn=collate_fn, generator=generator)
+
+# Epoch-free stream of (images, labels) batches, the training loop only calls next() on it.
+# If the loader ends (ex: CachedLoader) it is restarted right away. Epochs are only counted (in number of images)
+# to measure the throughput and the time spent waiting on data, in particular for the batch crossing the epoch boundary.
+class DataStream(object):
+	def __init__(self, loader, n, batch_size):
+		self.loader = loader
+		self.n = n
+		self.batch_size = batch_size
+		self.iterator = iter(loader)
+		self.epoch = 0
+		self.n_images = 0
+		self.epoch_images = 0
+		self.epoch_start = time.time()
+		self.epoch_wait = 0.0
+		# (epoch, images per second, seconds waiting on data, seconds waiting for the batch at the epoch boundary)
+		self.epoch_stats = []
+
+	# Number of batches in one epoch
+	def __len__(self):
+		return (self.n + self.batch_size - 1) // self.batch_size
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		wait_start = time.time()
+		try:
+			batch = next(self.iterator)
+		except StopIteration:
+			self.iterator = iter(self.loader)
+			batch = next(self.iterator)
+		wait = time.time() - wait_start
+		self.epoch_wait += wait
+		self.n_images += batch[0].size(0)
+		self.epoch_images += batch[0].size(0)
+		if self.n_images >= (self.epoch + 1) * self.n:
+			now = time.time()
+			self.epoch_stats.append((self.epoch, self.epoch_images / max(now - self.epoch_start, 1e-9), self.epoch_wait, wait))
+			self.epoch += 1
+			self.epoch_images = 0
+			self.epoch_start = now
+			self.epoch_wait = 0.0
+		return batch
+
+	def summary(self):
+		if len(self.epoch_stats) == 0:
+			return f"[data] epoch {self.epoch} in progress: {self.epoch_images} images"
+		epoch, images_per_sec, total_wait, boundary_wait = self.epoch_stats[-1]
+		return f"[data] epoch {epoch}: {images_per_sec:.1f} images/s, waited {total_wait:.4f}s on data, {boundary_wait:.4f}s at the epoch boundary"
+
+# Background double-buffered prefetcher: while the current step runs, a thread copies the next batch of images into
+# one of n_buffers pre-allocated buffers (pinned host memory then GPU if cuda, a reused host buffer otherwise). Batches which
+# are already pinned (DataLoader with pin_memory=True) skip the host buffer and are copied straight to the GPU buffer.
+# A buffer is only filled again once the training loop asked for the following batch (and, on GPU, once the kernels queued
+# on it are done). Batches are (images, ...) tuples like the DataLoader ones or only images (random_batches),
+# batch_size is the size of the biggest batch. wait is the time the training loop spent waiting on data.
+# The buffers are in memory_format (ex: torch.channels_last) so that the layout conversion is done by the copy, in the background.
+class Prefetcher(object):
+	def __init__(self, source, batch_size, cuda=False, n_buffers=2, memory_format=torch.contiguous_format):
+		self.source = source
+		self.batch_size = batch_size
+		self.cuda = cuda
+		self.n_buffers = n_buffers
+		self.memory_format = memory_format
+		self.buffers = None
+		self.wait = 0.0
+
+	def __len__(self):
+		return len(self.source)
+
+	# Time waited on data since the last call
+	def pop_wait(self):
+		wait, self.wait = self.wait, 0.0
+		return wait
+
+	def _allocate(self, images):
+		size = (self.batch_size,) + tuple(images.size()[1:])
+		self.buffers = []
+		for k in range(self.n_buffers):
+			host = torch.empty(size, dtype=images.dtype, pin_memory=self.cuda, memory_format=self.memory_format)
+			device = torch.empty(size, dtype=images.dtype, device='cuda', memory_format=self.memory_format) if self.cuda else host
+			self.buffers.append([host, device, None])
+		if self.cuda:
+			self.copy_stream = torch.cuda.Stream()
+
+	def _stage(self, k, images, release_event):
+		host, device, copy_event = self.buffers[k]
+		n = images.size(0)
+		if not self.cuda:
+			host[:n].copy_(images)
+			return host[:n], None
+		if images.is_pinned():
+			# Already in pinned memory (DataLoader with pin_memory=True), copied straight to the GPU without a host copy
+			source = images
+		else:
+			# The previous copy from this pinned buffer must be done before we overwrite it
+			if copy_event is not None:
+				copy_event.synchronize()
+			host[:n].copy_(images)
+			source = host[:n]
+		with torch.cuda.stream(self.copy_stream):
+			# The training loop must be done with this GPU buffer before we overwrite it
+			if release_event is not None:
+				self.copy_stream.wait_event(release_event)
+			if source.is_contiguous(memory_format=self.memory_format):
+				device[:n].copy_(source, non_blocking=True)
+			else:
+				# Layout converted on the GPU (a copy between different layouts would first convert it in pageable host memory)
+				device[:n].copy_(source.to('cuda', non_blocking=True))
+			copy_event = torch.cuda.Event()
+			copy_event.record(self.copy_stream)
+		self.buffers[k][2] = copy_event
+		return device[:n], copy_event
+
+	def _produce(self, iterator, ready, free):
+		try:
+			for batch in iterator:
+				images = batch[0] if isinstance(batch, (tuple, list)) else batch
+				if self.buffers is None:
+					self._allocate(images)
+				slot = free.get()
+				# The training loop stopped
+				if slot is None:
+					return
+				k, release_event = slot
+				staged, copy_event = self._stage(k, images, release_event)
+				if isinstance(batch, (tuple, list)):
+					staged = (staged,) + tuple(batch[1:])
+				ready.put((k, staged, copy_event))
+			ready.put(None)
+		except Exception as e:
+			ready.put(e)
+
+	def __iter__(self):
+		ready = queue.Queue()
+		free = queue.Queue()
+		for k in range(self.n_buffers):
+			free.put((k, None))
+		thread = threading.Thread(target=self._produce, args=(iter(self.source), ready, free), daemon=True)
+		thread.start()
+		k_used = None
+		try:
+			while True:
+				# The previous batch is not needed anymore so its buffer can be filled again
+				if k_used is not None:
+					release_event = None
+					if self.cuda:
+						release_event = torch.cuda.Event()
+						release_event.record(torch.cuda.current_stream())
+					free.put((k_used, release_event))
+				wait_start = time.time()
+				item = ready.get()
+				self.wait += time.time() - wait_start
+				if item is None:
+					return
+				if isinstance(item, Exception):
+					raise item
+				k_used, batch, copy_event = item
+				if copy_event is not None:
+					torch.cuda.current_stream().wait_event(copy_event)
+				yield batch
+		finally:
+			free.put(None)
@@ -0,0 +1,34 @@
+## Batched JPEG decoding
+# ImageFolder decodes the images one by one with PIL inside __getitem__. Instead, the dataset only reads the raw bytes
+# of the files and the whole batch is decoded at once by torchvision.io.decode_jpeg (libjpeg-turbo),
+# then resized and converted to [-1,1] as tensor operations. Only for JPEG images (ex: the CAT dataset).
+
+import torch
+import torchvision
+import torchvision.transforms.functional as F
+
+from data_cache import normalize_batch
+
+# Same files (and labels) as ImageFolder, but the items are the raw bytes of the files
+class JpegFiles(torch.utils.data.Dataset):
+	def __init__(self, root):
+		self.samples = torchvision.datasets.ImageFolder(root, loader=lambda path: path).samples
+
+	def __len__(self):
+		return len(self.samples)
+
+	def __getitem__(self, i):
+		path, label = self.samples[i]
+		return torchvision.io.read_file(path), label
+
+# collate_fn of the DataLoader: list of (bytes, label) to a batch of n_colors x image_size x image_size images in [-1,1],
+# so the decoding happens in the DataLoader workers
+class JpegDecoder(object):
+	def __init__(self, image_size):
+		self.image_size = image_size
+
+	def __call__(self, items):
+		images = torchvision.io.decode_jpeg([data for data, label in items], mode=torchvision.io.ImageReadMode.RGB)
+		# The images have different sizes so they are resized one by one (still uint8, antialiased like PIL), then stacked
+		images = torch.stack([F.resize(image, [self.image_size, self.image_size], antialias=True) for image in images], 0)
+		return normalize_batch(images), torch.tensor([label for data, label in items])
@@ -0,0 +1,152 @@
+## Metrics logged without synchronizing the device
+# log() only keeps the loss tensors (detached, still on the device), so logging costs no .item() (no wait for the device)
+# and no file write per step. Every `every` steps the window is reduced on the device to its mean, min and max per metric,
+# copied to the host asynchronously, and a background thread waits for the copy and writes the values to the sinks.
+# Sinks: TensorBoard (tensorboard_logger, the mean keeps the name of the metric, then name_min and name_max), CSV and JSONL.
+
+import csv
+import json
+import os
+import queue
+import threading
+
+import torch
+
+SINKS = ['tensorboard', 'csv', 'jsonl']
+
+class TensorBoardSink(object):
+	def __init__(self, logs_dir):
+		# Its own logger rather than the global one of tensorboard_logger.configure (which can only be configured once)
+		from tensorboard_logger import Logger
+		self.logger = Logger(logs_dir, flush_secs=5)
+
+	def write(self, step, stats):
+		for name, (mean, low, high) in stats.items():
+			self.logger.log_value(name, mean, step)
+			self.logger.log_value(f"{name}_min", low, step)
+			self.logger.log_value(f"{name}_max", high, step)
+
+	def close(self):
+		pass
+
+# One row per window: step, then mean, min and max of every metric (appended to the file of a resumed run)
+class CsvSink(object):
+	def __init__(self, path):
+		new = not os.path.exists(path)
+		self.file = open(path, 'a', newline='')
+		self.writer = csv.writer(self.file)
+		self.header = not new
+
+	def write(self, step, stats):
+		if not self.header:
+			self.writer.writerow(['step'] + [f"{name}_{s}" for name in stats for s in ('mean', 'min', 'max')])
+			self.header = True
+		self.writer.writerow([step] + [value for values in stats.values() for value in values])
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+# One json object per window: {"step": 50, "errD": {"mean": ..., "min": ..., "max": ...}, ...}
+class JsonlSink(object):
+	def __init__(self, path):
+		self.file = open(path, 'a')
+
+	def write(self, step, stats):
+		record = {'step': step}
+		for name, (mean, low, high) in stats.items():
+			record[name] = {'mean': mean, 'min': low, 'max': high}
+		self.file.write(json.dumps(record) + '\n')
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+# Sinks from their names (--metrics), the files are in logs_dir
+def make_sinks(names, logs_dir):
+	sinks = []
+	for name in names:
+		if name == 'tensorboard':
+			sinks.append(TensorBoardSink(logs_dir))
+		elif name == 'csv':
+			sinks.append(CsvSink(os.path.join(logs_dir, 'metrics.csv')))
+		elif name == 'jsonl':
+			sinks.append(JsonlSink(os.path.join(logs_dir, 'metrics.jsonl')))
+		else:
+			raise ValueError(f"Unknown metrics sink {name}, use one of {SINKS}")
+	return sinks
+
+class Metrics(object):
+	def __init__(self, sinks, every=50):
+		self.sinks = sinks
+		self.every = every
+		self.window = {}
+		self.n = 0
+		self.step = None
+		self.jobs = queue.Queue()
+		self.error = None
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	# values: name=loss (0-dim or 1-element tensors, or numbers), the same names at every step
+	def log(self, step, **values):
+		for name, value in values.items():
+			if isinstance(value, torch.Tensor):
+				value = value.detach()
+			self.window.setdefault(name, []).append(value)
+		self.n += 1
+		self.step = step
+		if self.n >= self.every:
+			self.flush()
+
+	def flush(self):
+		if self.n == 0:
+			return
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+		names = list(self.window)
+		device = next((v.device for v in self.window[names[0]] if isinstance(v, torch.Tensor)), torch.device('cpu'))
+		# (number of metrics, steps) -> (number of metrics, 3) on the device
+		values = torch.stack([self._column(self.window[name], device) for name in names])
+		stats = torch.stack([values.mean(1), values.amin(1), values.amax(1)], 1)
+		event = None
+		if stats.is_cuda:
+			# Copied to pinned memory without waiting, the background thread waits for the event
+			stats = stats.to('cpu', non_blocking=True)
+			event = torch.cuda.Event()
+			event.record()
+		self.jobs.put((self.step, names, stats, event))
+		self.window = {}
+		self.n = 0
+
+	# Values of a metric over the window as one float32 tensor (a single stack for the usual 0-dim losses)
+	def _column(self, values, device):
+		if all(isinstance(v, torch.Tensor) and v.dim() == 0 for v in values):
+			return torch.stack(values).to(device, torch.float32)
+		return torch.cat([torch.as_tensor(v, dtype=torch.float32, device=device).reshape(1) for v in values])
+
+	def _run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			step, names, stats, event = job
+			try:
+				if event is not None:
+					event.synchronize()
+				stats = dict(zip(names, stats.tolist()))
+				for sink in self.sinks:
+					sink.write(step, stats)
+			except Exception as e:
+				self.error = e
+
+	# Writes the last (incomplete) window, at the end of the training
+	def close(self):
+		self.flush()
+		self.jobs.put(None)
+		self.thread.join()
+		for sink in self.sinks:
+			sink.close()
+		if self.error is not None:
+			raise self.error
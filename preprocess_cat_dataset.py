@@ -1,30 +1,36 @@
 ## Modified version of https://github.com/microe/angora-blue/blob/master/cascade_training/describe.py by Erik Hovland
 ##### I modified it to work with Python 3, changed the paths and made it output a folder for images bigger than 64x64 and a folder for images bigger than 128x128
+##### Use --workers N to process the images with N processes (ex: python preprocess_cat_dataset.py --workers 8)
+##### Reruns only process the images which are new or changed since the last run (see --manifest)
+##### Use --archives to read the CAT dataset zip files directly, without unzipping them (see setting_up_script.sh)
+##### Use --resolutions to write training-ready arrays directly (ex: python preprocess_cat_dataset.py --resolutions 64 128 256 --no_jpeg)
 
+import argparse
 import cv2
+import functools
 import glob
+import hashlib
+import json
 import math
+import multiprocessing
+import numpy
+import os
 import sys
+import time
+import zipfile
 
 def rotateCoords(coords, center, angleRadians):
 	# Positive y is down so reverse the angle, too.
 	angleRadians = -angleRadians
-	xs, ys = coords[::2], coords[1::2]
-	newCoords = []
-	n = min(len(xs), len(ys))
-	i = 0
-	centerX = center[0]
-	centerY = center[1]
+	n = len(coords) // 2
 	cosAngle = math.cos(angleRadians)
 	sinAngle = math.sin(angleRadians)
-	while i < n:
-		xOffset = xs[i] - centerX
-		yOffset = ys[i] - centerY
-		newX = xOffset * cosAngle - yOffset * sinAngle + centerX
-		newY = xOffset * sinAngle + yOffset * cosAngle + centerY
-		newCoords += [newX, newY]
-		i += 1
-	return newCoords
+	# All the (x, y) points at once: newX = x*cos - y*sin, newY = x*sin + y*cos (around the center)
+	rotation = numpy.array([[cosAngle, sinAngle],
+							[-sinAngle, cosAngle]])
+	points = numpy.array(coords[:2*n], dtype=numpy.float64).reshape(n, 2) - center
+	newCoords = points.dot(rotation) + center
+	return newCoords.reshape(-1).tolist()
 
 def preprocessCatFace(coords, image):
 
@@ -48,13 +54,6 @@ def preprocessCatFace(coords, image):
 	eyesAngleRadians = math.atan2(eyesDeltaY, eyesDeltaX)
 	eyesAngleDegrees = eyesAngleRadians * 180.0 / math.pi
 
-	# Straighten the image and fill in gray for blank borders.
-	rotation = cv2.getRotationMatrix2D(
-			eyesCenter, eyesAngleDegrees, 1.0)
-	imageSize = image.shape[1::-1]
-	straight = cv2.warpAffine(image, rotation, imageSize,
-							  borderValue=(128, 128, 128))
-
 	# Straighten the coordinates of the features.
 	newCoords = rotateCoords(
 			coords, eyesCenter, eyesAngleRadians)
@@ -74,44 +73,327 @@ def preprocessCatFace(coords, image):
 		h += minY
 		minY = 0
 
-	# Crop the face.
-	crop = straight[int(minY):int(minY+h), int(minX):int(minX+w)]
+	# The crop window in the straightened image, with the same
+	# bounds as slicing the whole straightened image would give.
+	imageW, imageH = image.shape[1::-1]
+	startY, stopY, _ = slice(int(minY), int(minY+h)).indices(imageH)
+	startX, stopX, _ = slice(int(minX), int(minX+w)).indices(imageW)
+	cropH = max(0, stopY - startY)
+	cropW = max(0, stopX - startX)
+	if cropH == 0 or cropW == 0:
+		return numpy.empty((cropH, cropW) + image.shape[2:], dtype=image.dtype)
+
+	# Straighten the image and fill in gray for blank borders.
+	# Only the crop window is computed: the rotation is followed
+	# by a translation of the window to the origin.
+	rotation = cv2.getRotationMatrix2D(
+			eyesCenter, eyesAngleDegrees, 1.0)
+	rotation[0, 2] -= startX
+	rotation[1, 2] -= startY
+	crop = cv2.warpAffine(image, rotation, (cropW, cropH),
+						  borderValue=(128, 128, 128))
 	# Return the crop.
 	return crop
 
-def describePositive():
+# Array shard of n x 3 x resolution x resolution uint8 RGB images, in the same .npy format as data_cache.py
+# so that the trainers can use it directly with --data_cache. The number of images is only known at the end,
+# so the rows are appended to a raw temporary file which is then copied behind the .npy header.
+# Like data_cache.py, the rows are copied in a random order (seeded permutation, saved in <shard>_order.npy: row k of the shard
+# is the order[k]-th appended image), so that the contiguous batches of the trainers are random samples of the dataset.
+# After close(), position[i] is the row of the i-th appended image.
+class ShardWriter(object):
+	def __init__(self, path, resolution, seed=0):
+		self.path = path
+		self.resolution = resolution
+		self.seed = seed
+		self.n = 0
+		self.position = None
+		self.raw = open(path + '.tmp', 'wb')
+
+	def append(self, image):
+		self.raw.write(numpy.ascontiguousarray(image, dtype=numpy.uint8).tobytes())
+		self.n += 1
+
+	def close(self):
+		self.raw.close()
+		shape = (self.n, 3, self.resolution, self.resolution)
+		if self.n > 0:
+			rows = numpy.memmap(self.path + '.tmp', dtype=numpy.uint8, mode='r', shape=shape)
+		order = numpy.random.RandomState(self.seed).permutation(self.n)
+		self.position = numpy.argsort(order)
+		# Written next to the previous array and renamed, so that an interrupted run never leaves a half-written array
+		images = numpy.lib.format.open_memmap(self.path + '.new.npy', mode='w+', dtype=numpy.uint8, shape=shape)
+		for start in range(0, self.n, 1024):
+			images[start:start + 1024] = rows[order[start:start + 1024]]
+		images.flush()
+		del images
+		if self.n > 0:
+			del rows
+		os.remove(self.path + '.tmp')
+		orderPath = os.path.splitext(self.path)[0] + '_order.npy'
+		numpy.save(orderPath + '.new.npy', order)
+		os.replace(self.path + '.new.npy', self.path)
+		os.replace(orderPath + '.new.npy', orderPath)
+
+# Resize the crop once per resolution (only for crops at least that big, like the folders) to 3 x resolution x resolution RGB
+def resizeCrop(crop, resolutions):
+	h, w, colors = crop.shape
+	resized = {}
+	for resolution in resolutions:
+		if min(h,w) >= resolution:
+			small = cv2.resize(crop, (resolution, resolution), interpolation=cv2.INTER_AREA)
+			resized[resolution] = cv2.cvtColor(small, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)
+	return resized
+
+# Sources are either image paths (cat_dataset/00000001_000.jpg) or images inside a zip archive
+# (CAT_DATASET_01.zip!CAT_00/00000001_000.jpg) which are read directly, without extracting the archive.
+# The annotations are next to the images, unless a corrected '.cat' file is given (annotations: file name -> path).
+openArchives = {}
+
+def openArchive(archivePath):
+	# One handle per process, a handle inherited from the parent would share its file position
+	key = (os.getpid(), archivePath)
+	if key not in openArchives:
+		openArchives[key] = zipfile.ZipFile(archivePath)
+	return openArchives[key]
+
+def readAnnotation(source, annotations):
+	name = os.path.basename(source.split('!')[-1]) + '.cat'
+	if name in annotations:
+		with open(annotations[name], 'rb') as input:
+			return input.read()
+	if '!' in source:
+		archivePath, member = source.split('!', 1)
+		return openArchive(archivePath).read(member + '.cat')
+	with open('%s.cat' % source, 'rb') as input:
+		return input.read()
+
+def readImage(source):
+	if '!' in source:
+		archivePath, member = source.split('!', 1)
+		data = numpy.frombuffer(openArchive(archivePath).read(member), dtype=numpy.uint8)
+		return cv2.imdecode(data, cv2.IMREAD_COLOR)
+	return cv2.imread(source)
+
+# Sorted by file name so that the outputs and the report are the same whatever the number of workers (and archives)
+def listSources(archives=(), outliers=()):
+	if len(archives) == 0:
+		sources = glob.glob('cat_dataset/*.jpg')
+	else:
+		sources = []
+		for archivePath in archives:
+			with zipfile.ZipFile(archivePath) as archive:
+				sources += [f'{archivePath}!{member}' for member in archive.namelist() if member.endswith('.jpg')]
+	sources = [source for source in sources if os.path.basename(source.split('!')[-1]) not in outliers]
+	return sorted(sources, key=lambda source: os.path.basename(source.split('!')[-1]))
+
+# One file name per line, '#' starts a comment
+def loadOutliers(path):
+	outliers = set()
+	with open(path, 'r') as input:
+		for line in input:
+			line = line.split('#')[0].strip()
+			if line != '':
+				outliers.add(line)
+	return outliers
+
+def processImage(imagePath, resolutions=(), writeJpeg=True, annotations={}):
+	name = os.path.basename(imagePath.split('!')[-1])
+	# Open the '.cat' annotation file associated with this
+	# image.
+	input = readAnnotation(imagePath, annotations).decode()
+	# Read the coordinates of the cat features from the
+	# file. Discard the first number, which is the number
+	# of features.
+	coords = [int(i) for i in input.split('\n')[0].split()[1:]]
+	# Read the image.
+	image = readImage(imagePath)
+	if image is None:
+		raise IOError('cannot read image')
+	# Straighten and crop the cat face.
+	crop = preprocessCatFace(coords, image)
+	if crop is None:
+		raise ValueError('no crop')
+	# Save the crop to folders based on size
+	h, w, colors = crop.shape
+	outputs = []
+	if writeJpeg and min(h,w) >= 64:
+		Path1 = f'cats_bigger_than_64x64/{name}'
+		cv2.imwrite(Path1, crop)
+		outputs.append(Path1)
+	if writeJpeg and min(h,w) >= 128:
+		Path2 = f'cats_bigger_than_128x128/{name}'
+		cv2.imwrite(Path2, crop)
+		outputs.append(Path2)
+	# Append the cropped face and its bounds to the
+	# positive description.
+	#h, w = crop.shape[:2]
+	#print (cropPath, 1, 0, 0, w, h, file=output)
+	return outputs, resizeCrop(crop, resolutions)
+
+# Runs in the workers, errors are returned instead of raised so that one bad image doesn't stop the others
+def tryProcessImage(imagePath, resolutions=(), writeJpeg=True, annotations={}):
+	try:
+		outputs, resized = processImage(imagePath, resolutions, writeJpeg, annotations)
+		return imagePath, outputs, resized, None
+	except Exception as e:
+		return imagePath, [], {}, f'{type(e).__name__}: {e}'
+
+# Identity of a source image: size and modification time of the image, and hash of its annotations
+def sourceInfo(imagePath, annotations={}):
+	try:
+		catHash = hashlib.sha1(readAnnotation(imagePath, annotations)).hexdigest()
+		if '!' in imagePath:
+			archivePath, member = imagePath.split('!', 1)
+			info = openArchive(archivePath).getinfo(member)
+			return {'size': info.file_size, 'mtime': list(info.date_time), 'cat_hash': catHash}
+		stat = os.stat(imagePath)
+	except (OSError, KeyError):
+		return None
+	return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'cat_hash': catHash}
+
+def isUnchanged(entry, info):
+	if entry is None or info is None:
+		return False
+	if any(entry[key] != info[key] for key in ('size', 'mtime', 'cat_hash')):
+		return False
+	return all(os.path.exists(path) for path in entry['outputs'])
+
+# The manifest can only be reused if the previous run had the same settings and its arrays are still the ones it describes
+def loadManifest(manifestPath, settings, shardPaths):
+	if manifestPath is None or not os.path.exists(manifestPath):
+		return {}
+	with open(manifestPath, 'r') as input:
+		manifest = json.load(input)
+	if manifest.get('settings') != settings:
+		return {}
+	for resolution, path in shardPaths.items():
+		if not os.path.exists(path) or numpy.load(path, mmap_mode='r').shape[0] != manifest['shard_sizes'][str(resolution)]:
+			return {}
+	return manifest['images']
+
+def saveManifest(manifestPath, settings, images, shards):
+	shardSizes = {str(resolution): shard.n for resolution, shard in shards.items()}
+	with open(manifestPath + '.tmp', 'w') as output:
+		json.dump({'settings': settings, 'shard_sizes': shardSizes, 'images': images}, output)
+	os.replace(manifestPath + '.tmp', manifestPath)
+
+def removeOutputs(paths):
+	for path in paths:
+		if os.path.exists(path):
+			os.remove(path)
+
+def describePositive(workers=1, resolutions=(), shardFolder='.', writeJpeg=True, manifestPath=None, archives=(), outliers=(), annotations={}):
 	output = open('log.txt', 'w')
-	for imagePath in glob.glob('cat_dataset/*.jpg'):
-		# Open the '.cat' annotation file associated with this
-		# image.
-		input = open('%s.cat' % imagePath, 'r')
-		# Read the coordinates of the cat features from the
-		# file. Discard the first number, which is the number
-		# of features.
-		coords = [int(i) for i in input.readline().split()[1:]]
-		# Read the image.
-		image = cv2.imread(imagePath)
-		# Straighten and crop the cat face.
-		crop = preprocessCatFace(coords, image)
-		if crop is None:
-			print(f'Failed to preprocess image at {imagePath}.', file=sys.stderr)
+	imagePaths = listSources(archives, outliers)
+	start = time.time()
+
+	# With a manifest, only the new or changed images are processed and the outputs of the removed ones are deleted
+	settings = {'resolutions': sorted(resolutions), 'jpeg': writeJpeg}
+	shardPaths = {resolution: f'{shardFolder}/cats_{resolution}x{resolution}.npy' for resolution in resolutions}
+	manifest = loadManifest(manifestPath, settings, shardPaths)
+	infos = {imagePath: sourceInfo(imagePath, annotations) for imagePath in imagePaths}
+	changed = [imagePath for imagePath in imagePaths if not isUnchanged(manifest.get(imagePath), infos[imagePath])]
+	# An empty (or deleted) cat_dataset folder or archive doesn't mean that all the outputs should go
+	removed = [imagePath for imagePath in manifest if imagePath not in infos] if len(imagePaths) > 0 else []
+	for imagePath in removed:
+		removeOutputs(manifest[imagePath]['outputs'])
+	if len(changed) == 0 and len(removed) == 0:
+		s = f'Nothing to do, {len(imagePaths)} images unchanged since the last run, time:{time.time() - start:.4f}'
+		print(s)
+		print(s, file=output)
+		output.close()
+		return
+
+	# Rows of the unchanged images are copied from the previous arrays (read before the new ones replace them)
+	oldShards = {}
+	if len(manifest) > 0:
+		oldShards = {resolution: numpy.load(path, mmap_mode='r') for resolution, path in shardPaths.items()}
+	# One shard per resolution, the images are appended in the same (sorted) order, then shuffled when the shard is closed
+	shards = {resolution: ShardWriter(path, resolution) for resolution, path in shardPaths.items()}
+	process = functools.partial(tryProcessImage, resolutions=tuple(resolutions), writeJpeg=writeJpeg, annotations=annotations)
+	if workers > 1:
+		# Each image is independent, the files are sharded in chunks across the processes.
+		# OpenCV's own threads would compete with the processes so each worker only uses one.
+		pool = multiprocessing.Pool(workers, initializer=cv2.setNumThreads, initargs=(1,))
+		chunksize = max(1, len(changed) // (workers * 16))
+		results = pool.imap(process, changed, chunksize=chunksize)
+	else:
+		pool = None
+		results = map(process, changed)
+	changedSet = set(changed)
+	nOutputs = 0
+	failures = []
+	images = {}
+	for imagePath in imagePaths:
+		entry = manifest.get(imagePath)
+		if imagePath in changedSet:
+			imagePath, outputs, resized, error = next(results)
+			if entry is not None:
+				removeOutputs(set(entry['outputs']) - set(outputs))
+			if error is not None:
+				print(f'Failed to preprocess image at {imagePath}: {error}', file=sys.stderr)
+				print(f'Failed to preprocess image at {imagePath}: {error}', file=output)
+				failures.append(imagePath)
+				# Kept in the manifest so that it is only tried again if it changes
+				if infos[imagePath] is not None:
+					images[imagePath] = dict(infos[imagePath], outputs=[], rows={}, error=error)
+				continue
+			nOutputs += len(outputs)
+		elif entry.get('error') is not None:
+			images[imagePath] = entry
 			continue
-		# Save the crop to folders based on size
-		h, w, colors = crop.shape
-		if min(h,w) >= 64:
-			Path1 = imagePath.replace("cat_dataset","cats_bigger_than_64x64")
-			cv2.imwrite(Path1, crop)
-		if min(h,w) >= 128:
-			Path2 = imagePath.replace("cat_dataset","cats_bigger_than_128x128")
-			cv2.imwrite(Path2, crop)
-		# Append the cropped face and its bounds to the
-		# positive description.
-		#h, w = crop.shape[:2]
-		#print (cropPath, 1, 0, 0, w, h, file=output)
+		else:
+			outputs = entry['outputs']
+			# Copies, so that nothing refers to the previous arrays once they are replaced
+			resized = {int(resolution): numpy.array(oldShards[int(resolution)][row]) for resolution, row in entry['rows'].items()}
+		rows = {}
+		for resolution, image in resized.items():
+			rows[str(resolution)] = shards[resolution].n
+			shards[resolution].append(image)
+		if infos[imagePath] is not None:
+			images[imagePath] = dict(infos[imagePath], outputs=outputs, rows=rows)
+	if pool is not None:
+		pool.close()
+		pool.join()
+	oldShards.clear()
+	for resolution, shard in shards.items():
+		shard.close()
+		# Rows of the images in the shuffled shard
+		for entry in images.values():
+			if str(resolution) in entry['rows']:
+				entry['rows'][str(resolution)] = int(shard.position[entry['rows'][str(resolution)]])
+		s = f'Shard {shard.path}: {shard.n} images of size {resolution}x{resolution}'
+		print(s)
+		print(s, file=output)
+	if manifestPath is not None:
+		saveManifest(manifestPath, settings, images, shards)
+	s = f'Processed {len(changed)} new or changed images out of {len(imagePaths)} with {workers} workers: {len(changed) - len(failures)} succeeded, {len(failures)} failed, {nOutputs} crops written, {len(removed)} removed, time:{time.time() - start:.4f}'
+	print(s)
+	print(s, file=output)
+	output.close()
 
 
 def main():
-	describePositive()
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--workers', type=int, default=1, help='Number of processes to use, the number of cpu cores is a good choice.')
+	parser.add_argument('--resolutions', type=int, nargs='*', default=[], help='Also resize every crop to these sizes (ex: 64 128 256) and write them in one array per size, to use with --data_cache in the trainers.')
+	parser.add_argument('--shard_folder', default='.', help='Folder where the arrays of --resolutions are written.')
+	parser.add_argument('--no_jpeg', action='store_true', help='Only write the arrays of --resolutions, not the cats_bigger_than_* JPEG folders.')
+	parser.add_argument('--manifest', default='preprocess_manifest.json', help='File recording the sources and outputs of every image, so that reruns only process the new or changed images.')
+	parser.add_argument('--full', action='store_true', help='Ignore the manifest and process all the images again.')
+	parser.add_argument('--archives', nargs='*', default=[], help='Read the images and annotations directly from these zip archives instead of the cat_dataset folder (ex: CAT_DATASET_01.zip CAT_DATASET_02.zip).')
+	parser.add_argument('--outliers', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cat_outliers.txt'), help='File with the names of the images to leave out (one per line).')
+	parser.add_argument('--annotations', nargs='*', default=[], help='Corrected .cat files, used instead of the ones with the same name next to the images (ex: 00000003_015.jpg.cat).')
+	param = parser.parse_args()
+	if param.full and os.path.exists(param.manifest):
+		os.remove(param.manifest)
+	outliers = loadOutliers(param.outliers) if os.path.exists(param.outliers) else set()
+	annotations = {os.path.basename(path): path for path in param.annotations}
+	for folder in ('cats_bigger_than_64x64', 'cats_bigger_than_128x128'):
+		if not param.no_jpeg and not os.path.exists(folder):
+			os.mkdir(folder)
+	describePositive(workers=param.workers, resolutions=param.resolutions, shardFolder=param.shard_folder, writeJpeg=not param.no_jpeg, manifestPath=param.manifest, archives=param.archives, outliers=outliers, annotations=annotations)
 
 if __name__ == '__main__':
 	main()
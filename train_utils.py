@@ -0,0 +1,260 @@
+## Helpers shared by the training scripts (DCGAN.py, LSGAN.py, WGAN.py, WGAN-GP.py)
+
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import time
+
+import torch
+import torchvision.utils as vutils
+
+## Reduced precision
+# The forward passes of D and G run under autocast in bfloat16 or float16 (the weights, the optimizers and the losses stay in float32).
+# bfloat16 has the same range as float32 so the gradients don't need scaling, float16 gradients underflow so they are scaled.
+# Use one scaler per optimizer: loss.backward() -> scaler.scale(loss).backward(), optimizer.step() -> scaler.step(optimizer); scaler.update()
+class Precision(object):
+	def __init__(self, precision, cuda):
+		self.device_type = 'cuda' if cuda else 'cpu'
+		self.dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+		self.enabled = precision != 'fp32'
+		self.scaled = precision == 'fp16'
+
+	def autocast(self):
+		if not self.enabled:
+			return contextlib.nullcontext()
+		return torch.autocast(self.device_type, dtype=self.dtype)
+
+	# Scaler which does nothing (and costs nothing) with fp32 and bf16
+	def scaler(self):
+		return torch.amp.GradScaler(self.device_type, enabled=self.scaled)
+
+# Gradients of D(x_both) with respect to x_both for the gradient penalty of WGAN-GP (create_graph=True so that the penalty can be backpropagated).
+# grad_outputs: ones of the size of D(x_both), made here if None.
+# With float16 the outputs are scaled before the double-backward (like the loss) so that the gradients don't underflow, then unscaled
+# (divided by the scale as a tensor on the device: get_scale() would wait for the device at every critic step).
+# The gradients are returned in float32 so that the norm and the penalty are computed in full precision.
+# D.forward bypasses the graphs compiled by compile_model, they don't support double backward.
+def penalty_gradients(D, x_both, grad_outputs, precision, scaler):
+	with precision.autocast():
+		output = D.forward(x_both)
+	if grad_outputs is None:
+		grad_outputs = torch.ones_like(output, dtype=torch.float32)
+	grad = torch.autograd.grad(outputs=scaler.scale(output.float()), inputs=x_both, grad_outputs=grad_outputs, create_graph=True, only_inputs=True)[0]
+	if scaler.is_enabled():
+		grad = grad / scaler.scale(torch.ones((), device=grad.device))
+	return grad.float()
+
+# Norm of the gradient of each image (batch_size x n_colors x image_size x image_size -> batch_size), one reduction over the
+# flattened images instead of three successive norms (also works without copy on channels_last gradients)
+def gradient_norm(grad):
+	return torch.linalg.vector_norm(grad, 2, dim=tuple(range(1, grad.dim())))
+
+# Fused critic step of WGAN-GP: the real and fake images go through D in a single forward pass and the outputs are split.
+# Only possible because the D of WGAN-GP has no BatchNorm (the output of an image doesn't depend on the other images of the batch).
+# The interpolated images keep their own forward pass: in the fused batch, the double-backward of the penalty would go through
+# the real and fake images too (3 times the work of the penalty).
+# Returns errD_real, errD_fake and grad_penalty in float32, then do scaler.scale(errD_fake - errD_real + grad_penalty).backward()
+# With penalty=0 (critic steps without penalty, see --penalty_every) the interpolated images are skipped.
+def fused_critic(D, x, x_fake, u, penalty, precision, scaler):
+	n = x.size(0)
+	with precision.autocast():
+		output = D.forward(torch.cat([x, x_fake], 0))
+	output = output.float()
+	grad_penalty = torch.zeros((), device=output.device)
+	if penalty != 0:
+		# We only want the gradients with respect to x_both
+		x_both = (x*u + x_fake*(1-u)).detach().requires_grad_(True)
+		grad = penalty_gradients(D, x_both, None, precision, scaler)
+		grad_penalty = penalty*((gradient_norm(grad) - 1) ** 2).mean()
+	return output[:n].mean(), output[n:].mean(), grad_penalty
+
+## torch.compile
+# The model is compiled in place (nn.Module.compile) so its parameters, its state_dict and the saved models don't change.
+# The graphs are only built on the first calls, so they are first built through a torch.compile wrapper of the model (forward
+# and backward on a batch of zeros, with the training precision) to measure the compilation time and to leave the model in
+# eager mode if compiling isn't supported (old pytorch, no C++ compiler, etc.). Only then the model itself is compiled, it
+# reuses the graphs of the warm-up. Returns the message to log.
+# Compiled graphs don't support double backward (gradient penalty), model.forward(...) bypasses them.
+def compile_model(model, example, precision, name):
+	if not hasattr(model, 'compile'):
+		return f"[compile] torch.compile is not available in pytorch {torch.__version__}, {name} runs in eager mode"
+	# The warm-up must not change the BatchNorm statistics nor the gradients
+	buffers = [b.clone() for b in model.buffers()]
+	start = time.time()
+	try:
+		with precision.autocast():
+			output = torch.compile(model)(example)
+		output.float().sum().backward()
+	except Exception as e:
+		return f"[compile] compiling {name} failed, running in eager mode ({type(e).__name__}: {str(e).splitlines()[0]})"
+	finally:
+		for b, saved in zip(model.buffers(), buffers):
+			b.copy_(saved)
+		model.zero_grad()
+	model.compile()
+	return f"[compile] {name} compiled in {time.time() - start:.1f}s"
+
+## Memory format
+# channels_last (NHWC) convolutions are often faster (oneDNN on CPU, tensor cores on GPU), but only if all the 4D tensors
+# of the step are in this format: mixing layouts makes pytorch convert them back and forth (hidden copies).
+MEMORY_FORMATS = {'contiguous': torch.contiguous_format, 'channels_last': torch.channels_last}
+
+# Records the layers of the models whose 4D input or output is not in memory_format (a layout conversion) until report() is called.
+# Uses forward hooks so it only sees the eager forward passes (not the ones compiled by compile_model).
+class LayoutCheck(object):
+	def __init__(self, models, memory_format):
+		self.memory_format = memory_format
+		self.conversions = []
+		self.handles = []
+		for model_name, model in models.items():
+			for name, module in model.named_modules():
+				# Only the layers (not the containers)
+				if len(list(module.children())) == 0:
+					self.handles.append(module.register_forward_hook(functools.partial(self._check, f"{model_name}.{name}")))
+
+	def _check(self, name, module, inputs, output):
+		for kind, tensor in [('input', inputs[0] if len(inputs) > 0 else None), ('output', output)]:
+			if isinstance(tensor, torch.Tensor) and tensor.dim() == 4 and not tensor.is_contiguous(memory_format=self.memory_format):
+				self.conversions.append(f"{name} ({kind})")
+
+	# Removes the hooks, returns the message to log
+	def report(self):
+		for handle in self.handles:
+			handle.remove()
+		self.handles = []
+		if len(self.conversions) == 0:
+			return "[layout] no layout conversion in the first step"
+		# Unique layers, in the order of the forward passes
+		conversions = list(dict.fromkeys(self.conversions))
+		return f"[layout] {len(conversions)} layers got tensors in the wrong memory format (copied): {', '.join(conversions)}"
+
+## Timing
+# Time spent in a part of the training step, use "with timer:" around it, pop() returns the seconds since the last pop().
+# On GPU the time is measured with CUDA events so the step is not synchronized (only pop() waits for the events).
+class SectionTimer(object):
+	def __init__(self, cuda):
+		self.cuda = cuda
+		self.events = []
+		self.total = 0.0
+
+	def __enter__(self):
+		if self.cuda:
+			self.start = torch.cuda.Event(enable_timing=True)
+			self.start.record()
+		else:
+			self.start = time.time()
+		return self
+
+	def __exit__(self, *args):
+		if self.cuda:
+			end = torch.cuda.Event(enable_timing=True)
+			end.record()
+			self.events.append((self.start, end))
+		else:
+			self.total += time.time() - self.start
+
+	def pop(self):
+		for start, end in self.events:
+			end.synchronize()
+			# In milliseconds
+			self.total += start.elapsed_time(end) / 1000
+		self.events = []
+		total, self.total = self.total, 0.0
+		return total
+
+## Spectral normalization
+# Lipschitz constraint of the critic without weight clipping nor gradient penalty: the weight of every convolution of D is divided
+# by its largest singular value, estimated with n_power_iterations power iterations per forward pass (in training mode).
+# To do after the weights initialization and before loading a saved D (the state_dict has the parametrized weights).
+def spectral_norm(D, n_power_iterations=1):
+	for module in D.modules():
+		if isinstance(module, torch.nn.Conv2d):
+			torch.nn.utils.parametrizations.spectral_norm(module, n_power_iterations=n_power_iterations)
+
+## Weight clipping
+# Clipping of the weights of the WGAN critic on the list of parameters made once. On GPU, with multi-tensor operations
+# (torch._foreach, a few kernel launches for all the parameters instead of one per parameter). On CPU the _foreach operations
+# are only a loop over the tensors and clamp_min_ then clamp_max_ read the weights twice, so a clamp_ per parameter is faster.
+class WeightClipper(object):
+	def __init__(self, model, clip):
+		self.params = list(model.parameters())
+		self.clip = clip
+
+	@torch.no_grad()
+	def __call__(self):
+		if self.params[0].is_cuda and hasattr(torch, '_foreach_clamp_min_'):
+			torch._foreach_clamp_min_(self.params, -self.clip)
+			torch._foreach_clamp_max_(self.params, self.clip)
+		else:
+			for p in self.params:
+				p.clamp_(-self.clip, self.clip)
+
+## Batched fake images
+# The fake images of the critic steps are generated in a few big no-grad forward passes of G instead of one per critic step
+# (bigger kernels, fewer launches). memory_mb caps the memory of one pass: the fake images kept for the next critic steps
+# plus the biggest activations of G (measured once). If all the critic steps don't fit, the fakes are generated in chunks of as many batches as fit.
+# Note: the BatchNorm of G (in training mode) computes its statistics over the whole chunk.
+class FakeBatches(object):
+	def __init__(self, G, z_size, precision, memory_mb):
+		self.G = G
+		self.z_size = z_size
+		self.precision = precision
+		self.memory = memory_mb * 2**20
+		self.device = next(G.parameters()).device
+		self.sample_bytes = None
+
+	# Bytes per image of a forward pass of G: biggest input + output of a layer and the fake image itself
+	def _measure(self):
+		sizes = []
+		def hook(module, inputs, output):
+			sizes.append((inputs[0].numel() + output.numel()) * output.element_size())
+		handles = [m.register_forward_hook(hook) for m in self.G.modules() if len(list(m.children())) == 0]
+		# In eval mode so that the running statistics of BatchNorm don't change
+		training = self.G.training
+		self.G.eval()
+		with torch.no_grad():
+			fake = self.G(torch.zeros(2, self.z_size, 1, 1, device=self.device))
+		self.G.train(training)
+		for handle in handles:
+			handle.remove()
+		self.sample_bytes = (max(sizes) + fake.numel() * fake.element_size()) // 2
+
+	# Number of batches of batch_size images generated at once
+	def chunk_size(self, batch_size):
+		if self.sample_bytes is None:
+			self._measure()
+		return max(1, int(self.memory // (self.sample_bytes * batch_size)))
+
+	# Fake images of the next n_steps critic steps (batches of batch_size images), generated chunk by chunk when needed
+	def generate(self, n_steps, batch_size):
+		chunk = min(n_steps, self.chunk_size(batch_size))
+		for start in range(0, n_steps, chunk):
+			n = min(chunk, n_steps - start)
+			z = torch.randn(n * batch_size, self.z_size, 1, 1, device=self.device)
+			with torch.no_grad(), self.precision.autocast():
+				x_fake = self.G(z)
+			for k in range(n):
+				yield x_fake[k*batch_size:(k+1)*batch_size]
+
+## Sample images written in the background
+# The grids are made and encoded to PNG by a pool of threads (zlib releases the GIL), the training thread only copies the images
+# to host memory. At most max_pending images wait to be written: saving more waits for the oldest one (bounded memory).
+class ImageWriter(object):
+	def __init__(self, n_workers=2, max_pending=8):
+		self.pool = concurrent.futures.ThreadPoolExecutor(n_workers)
+		self.max_pending = max_pending
+		self.pending = collections.deque()
+
+	def save(self, images, path):
+		# The finished ones are removed (and their errors raised) first
+		while len(self.pending) > 0 and (self.pending[0].done() or len(self.pending) >= self.max_pending):
+			self.pending.popleft().result()
+		images = images.detach().to('cpu', torch.float32, copy=True)
+		self.pending.append(self.pool.submit(vutils.save_image, images, path, normalize=True))
+
+	# Waits for the last images (at the end of the training)
+	def close(self):
+		while len(self.pending) > 0:
+			self.pending.popleft().result()
+		self.pool.shutdown()